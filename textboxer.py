@@ -4,11 +4,36 @@
 # Made by TheLastKumquat
 # Licensed under MIT
 
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import io
 import json
 import math
+import mmap
+import os
 import sys
-
-from copy import deepcopy
+import tarfile
+import threading
+import time
+import weakref
+
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import deque
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from functools import lru_cache
+from functools import partial
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
 
 from PIL import Image
 from PIL import ImageDraw
@@ -18,41 +43,670 @@ from pathlib import Path
 
 debug_mode = False
 resource_root: Path = Path("resources")
-resolve_with_paths = False
+# set by resolve_next_with_path, per thread (and asyncio task) so concurrent renders don't see each other's
+resolve_with_paths = contextvars.ContextVar("resolve_with_paths", default=False)
+# re-stat style data files on every lookup, so edited styles are picked up without a restart
+check_style_changes = True
+style_cache = {}
+# load styles from their compiled bundle (see compile_style) when there is one
+use_bundles = True
+# output cache, see generate and get_cached_output
+use_output_cache = False
+# directory for the on-disk tier of the output cache, None keeps outputs in memory only
+output_cache_dir: Path = None
+output_cache_dir_budget = 512 * 1024 * 1024
+# executor agenerate and aparsestr render on, a thread pool of async_limit threads is made if this is None
+async_executor = None
+# most renders agenerate and aparsestr run at once per event loop, set before the first call
+async_limit = 4
+# per-stage render timings, see enable_stats, None when disabled so nothing gets timed at all
+render_stats = None
+# functions called with (stage, seconds) after every timed stage while stats are enabled
+stats_hooks = []
+stats_lock = threading.Lock()
 
 
 def debug(text):
-    if debug_mode:
+    if current_renderer().debug:
         print(text)
 
 
+def enable_stats(hook=None):
+    # starts (or restarts) collecting stats, hook is added to stats_hooks
+    global render_stats
+    with stats_lock:
+        render_stats = {"renders": 0, "seconds": {}, "counts": {}, "caches": cache_counters()}
+        if hook is not None and hook not in stats_hooks:
+            stats_hooks.append(hook)
+
+
+def disable_stats():
+    global render_stats
+    with stats_lock:
+        render_stats = None
+        stats_hooks.clear()
+
+
+def cache_counters() -> dict:
+    counters = {name: (cache.hits, cache.misses) for name, cache in stat_caches().items()}
+    # the output cache of the module level functions, Renderers have their own (see Renderer.output_cache_info)
+    counters["output_cache"] = (output_cache_stats["hits"] + output_cache_stats["disk_hits"],
+                                output_cache_stats["misses"])
+    return counters
+
+
+def stat_caches() -> dict:
+    return {"font_cache": font_cache, "image_cache": image_cache, "expand_cache": expand_cache,
+            "scaled_cache": scaled_cache, "background_cache": background_cache, "layout_cache": layout_cache,
+            "line_mask_cache": line_mask_cache}
+
+
+def get_stats() -> dict | None:
+    # total seconds and number of times each stage ran, and cache hits and misses, since enable_stats
+    # stages are resolve, fonts, layout, images, composite, text, postscale and encode
+    with stats_lock:
+        if render_stats is None:
+            return None
+        stats = {"renders": render_stats["renders"], "seconds": dict(render_stats["seconds"]),
+                 "counts": dict(render_stats["counts"]), "caches": {}}
+        start = render_stats["caches"]
+    for name, (hits, misses) in cache_counters().items():
+        stats["caches"][name] = {"hits": hits - start[name][0], "misses": misses - start[name][1]}
+    return stats
+
+
+def record_stage(stage: str, start: float) -> float:
+    # adds the time since start to stage, and returns the current time to start the next stage from
+    now = time.perf_counter()
+    with stats_lock:
+        if render_stats is not None:
+            render_stats["seconds"][stage] = render_stats["seconds"].get(stage, 0) + now - start
+            render_stats["counts"][stage] = render_stats["counts"].get(stage, 0) + 1
+        hooks = list(stats_hooks)
+    for hook in hooks:
+        hook(stage, now - start)
+    return now
+
+
+class BoundedCache:
+    # policy is "lru" to evict the least recently used entry first, or "fifo" to evict the oldest one
+    # maxsize limits the number of entries, budget limits the total of sizeof() over all entries
+    def __init__(self, maxsize: int = None, budget: int = None, sizeof=None, policy: str = "lru"):
+        self.maxsize = maxsize
+        self.budget = budget
+        self.sizeof = sizeof
+        self.policy = policy
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                if self.policy == "lru":
+                    self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.sizeof is not None else 0
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.sizes[key]
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self.sizes[key] = size
+            self.size += size
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.size -= self.sizes.pop(key)
+            return self.entries.pop(key)
+
+    def evict(self):
+        # call after changing maxsize or budget
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        while len(self.entries) > 0 and (self.maxsize is not None and len(self.entries) > self.maxsize
+                                         or self.budget is not None and self.size > self.budget):
+            key, _ = self.entries.popitem(last=False)
+            self.size -= self.sizes.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.size = 0
+
+
+def image_bytes(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+# shared between all renders, keyed by (font file, size), size is None for bitmap fonts
+font_cache = BoundedCache(32)
+# decoded image files, keyed by path
+image_cache = BoundedCache(budget=64 * 1024 * 1024, sizeof=image_bytes)
+# finished expand images, keyed by (path, size, divide)
+expand_cache = BoundedCache(budget=32 * 1024 * 1024, sizeof=image_bytes)
+# wrapped text and its size, see layout_text
+layout_cache = BoundedCache(1024)
+# rendered lines of bitmap fonts, keyed by (font, font mode, line), see draw_bitmap_text
+line_mask_cache = BoundedCache(1024)
+# resized images, keyed by (what they were resized from, size, filter), see scale_image
+scaled_cache = BoundedCache(budget=32 * 1024 * 1024, sizeof=image_bytes)
+# static layers flattened into one image, keyed by canvas size and each layer's source and position,
+#   see static_background
+background_cache = BoundedCache(budget=32 * 1024 * 1024, sizeof=image_bytes)
+# per-font glyph measurements used by wrap_text
+glyph_tables = weakref.WeakKeyDictionary()
+# parsed alias.json files, keyed by path, see load_alias_file
+alias_files = {}
+# per-style alias lookup tables, keyed by (resource root, style), see get_alias_index
+alias_indexes = {}
+# mapped bundle files, keyed by path, see load_bundle
+bundles = {}
+# images stored decoded in a bundle, keyed by image path, see load_image
+bundled_images = {}
+bundle_magic = b"textboxer bundle 1\n"
+# mapped image packs, keyed by the directory they pack, see load_pack
+packs = {}
+# images stored in a pack, keyed by image path, see load_image
+packed_images = {}
+pack_name = "images.pack"
+pack_magic = b"textboxer pack 1\n"
+# encoded renders, keyed by output_key, in front of output_cache_dir
+output_cache = BoundedCache(budget=32 * 1024 * 1024, sizeof=len)
+output_cache_stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+output_cache_lock = threading.Lock()
+# total size of output_cache_dir, None until it's been scanned
+output_dir_size = None
+# hashes of every file in a style, keyed by (resource root, style), see style_fingerprint
+style_fingerprints = {}
+# per event loop semaphore and in-flight renders, see get_async_state
+async_states = weakref.WeakKeyDictionary()
+# renders in progress for the HTTP server, keyed by output_key, see render_once
+server_renders = {}
+server_renders_lock = threading.Lock()
+
+
+# the Renderer the module level functions use while a Renderer method is running, see current_renderer
+active_renderer = contextvars.ContextVar("active_renderer", default=None)
+
+
+class Renderer:
+    # a resource root with its own options, and its own style, alias and output caches
+    # one can be shared between threads, and any number of renders can run on it at once
+    # fonts, images and layouts are cached by path or content, so those caches stay shared by every Renderer
+    # the methods are the module level functions of the same name, run with this Renderer active
+    def __init__(self, root: Path = Path("resources"), *, debug: bool = False, check_style_changes: bool = True,
+                 use_bundles: bool = True, use_output_cache: bool = False, output_cache_dir: Path = None,
+                 output_cache_dir_budget: int = 512 * 1024 * 1024, output_cache_budget: int = 32 * 1024 * 1024):
+        self.resource_root = Path(root)
+        self.debug = debug
+        self.check_style_changes = check_style_changes
+        self.use_bundles = use_bundles
+        self.use_output_cache = use_output_cache
+        self.output_cache_dir = output_cache_dir
+        self.output_cache_dir_budget = output_cache_dir_budget
+        self.style_cache = {}
+        self.alias_indexes = {}
+        self.style_fingerprints = {}
+        self.output_cache = BoundedCache(budget=output_cache_budget, sizeof=len)
+        self.output_cache_stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+        self.output_cache_lock = threading.Lock()
+        self.output_dir_size = None
+
+    def options(self) -> dict:
+        # the arguments to make an equivalent Renderer with, without the cached data
+        return {"root": self.resource_root, "debug": self.debug, "check_style_changes": self.check_style_changes,
+                "use_bundles": self.use_bundles, "use_output_cache": self.use_output_cache,
+                "output_cache_dir": self.output_cache_dir, "output_cache_dir_budget": self.output_cache_dir_budget,
+                "output_cache_budget": self.output_cache.budget}
+
+    def run(self, func, *args, **kwargs):
+        # func(*args, **kwargs) with this Renderer active, only in the calling thread (or task)
+        token = active_renderer.set(self)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            active_renderer.reset(token)
+
+    def iterate(self, iterator):
+        # like run, for generators, which would otherwise run outside of it
+        while True:
+            try:
+                item = self.run(next, iterator)
+            except StopIteration:
+                return
+            yield item
+
+    async def arun(self, func, *args, **kwargs):
+        # like run, for coroutine functions
+        token = active_renderer.set(self)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            active_renderer.reset(token)
+
+    def generate(self, *args, **kwargs):
+        return self.run(generate, *args, **kwargs)
+
+    def generate_image(self, *args, **kwargs) -> Image.Image:
+        return self.run(generate_image, *args, **kwargs)
+
+    def generate_animation(self, *args, **kwargs):
+        return self.run(generate_animation, *args, **kwargs)
+
+    def generate_batch(self, *args, **kwargs):
+        return self.iterate(generate_batch(*args, **kwargs))
+
+    def parsestr(self, *args, **kwargs):
+        return self.run(parsestr, *args, **kwargs)
+
+    def parsestr_args(self, *args, **kwargs) -> dict:
+        return self.run(parsestr_args, *args, **kwargs)
+
+    async def agenerate(self, *args, **kwargs):
+        return await self.arun(agenerate, *args, **kwargs)
+
+    async def aparsestr(self, *args, **kwargs):
+        return await self.arun(aparsestr, *args, **kwargs)
+
+    def render_parallel(self, *args, **kwargs):
+        return self.iterate(render_parallel(*args, **kwargs))
+
+    def run_batch(self, *args, **kwargs) -> (int, int):
+        return self.run(run_batch, *args, **kwargs)
+
+    def make_server(self, *args, **kwargs) -> ThreadingHTTPServer:
+        return self.run(make_server, *args, **kwargs)
+
+    def load_style(self, style: str = None) -> (dict[int, list], dict[str, dict]):
+        return self.run(load_style, style)
+
+    def warm_style(self, style: str):
+        return self.run(warm_style, style)
+
+    def compile_style(self, style: str, out: Path = None) -> Path:
+        return self.run(compile_style, style, out)
+
+    def list_styles(self) -> list[str]:
+        return self.run(list_styles)
+
+    def get_image(self, style: str, image: str) -> Path | None:
+        return self.run(get_image, style, image)
+
+    def search_aliases(self, style: str, search: str = "", prefix: bool = False) -> list[str]:
+        return self.run(search_aliases, style, search, prefix)
+
+    def find_aliases(self, stylein: str = None, search: str = "", prefix: bool = False) -> str:
+        return self.run(find_aliases, stylein, search, prefix)
+
+    def gen_help(self) -> str:
+        return self.run(gen_help)
+
+    def clear_output_cache(self):
+        return self.run(clear_output_cache)
+
+    def output_cache_info(self) -> dict:
+        return self.run(output_cache_info)
+
+
+def module_option(name: str) -> property:
+    # reads and writes the module global name, so setting textboxer.<name> keeps working
+    def set_option(self, value):
+        globals()[name] = value
+    return property(lambda self: globals()[name], set_option)
+
+
+class ModuleRenderer(Renderer):
+    # the Renderer the module level functions use when no other one is active
+    # its options and caches are the module globals of the same name (debug is debug_mode)
+    resource_root = module_option("resource_root")
+    debug = module_option("debug_mode")
+    check_style_changes = module_option("check_style_changes")
+    use_bundles = module_option("use_bundles")
+    use_output_cache = module_option("use_output_cache")
+    output_cache_dir = module_option("output_cache_dir")
+    output_cache_dir_budget = module_option("output_cache_dir_budget")
+    style_cache = module_option("style_cache")
+    alias_indexes = module_option("alias_indexes")
+    style_fingerprints = module_option("style_fingerprints")
+    output_cache = module_option("output_cache")
+    output_cache_stats = module_option("output_cache_stats")
+    output_cache_lock = module_option("output_cache_lock")
+    output_dir_size = module_option("output_dir_size")
+
+    def __init__(self):
+        pass
+
+
+module_renderer = ModuleRenderer()
+
+
+def current_renderer() -> Renderer:
+    renderer = active_renderer.get()
+    return renderer if renderer is not None else module_renderer
+
+
 def resolve_next_with_path():
-    global resolve_with_paths
-    resolve_with_paths = True
+    resolve_with_paths.set(True)
 
 
 def resolve_resource(base: Path, key: str) -> Path | None:
-    global resolve_with_paths
-    if resolve_with_paths and (base / key).exists():
-        resolve_with_paths = False
+    pack = load_pack(base)
+    if resolve_with_paths.get() and ((base / key).exists() or pack is not None and key in pack["files"]):
+        resolve_with_paths.set(False)
         return base / key
 
-    if (base / "alias.json").exists():
-        alias_file = (base / "alias.json").open()
-        aliases = json.load(alias_file)
-        alias_file.close()
-        if key in aliases:
-            return base / aliases[key]
+    alias_file = load_alias_file(base / "alias.json")
+    if alias_file is not None and key in alias_file["aliases"]:
+        return base / alias_file["aliases"][key]
+    # a pack's aliases are used when its directory has no alias.json any more
+    if pack is not None and alias_file is None and key in pack["aliases"]:
+        return base / pack["aliases"][key]
 
     return None
 
 
+def pack_images(directory: Path, out: Path = None) -> Path:
+    # packs every image file under directory, still encoded, into one file along with its alias.json
+    # once packed, the image files (and alias.json) can be deleted, and resolve_resource and load_image use the pack
+    # layout: pack_magic, header length (8 bytes, little endian), JSON header, image files
+    if out is None:
+        out = directory / pack_name
+    extensions = Image.registered_extensions()
+    header = {"files": {}, "aliases": {}}
+    if (directory / "alias.json").exists():
+        alias_file = (directory / "alias.json").open()
+        header["aliases"] = json.load(alias_file)
+        alias_file.close()
+
+    image_paths = []
+    offset = 0
+    for path in sorted(directory.rglob("*")):
+        if path.is_file() and path.suffix.lower() in extensions:
+            stat = os.stat(path)
+            header["files"][path.relative_to(directory).as_posix()] = [offset, stat.st_size, stat.st_mtime_ns]
+            image_paths.append(path)
+            offset += stat.st_size
+
+    header_bytes = json.dumps(header).encode()
+    temp_path = out.with_name(out.name + ".tmp")
+    pack_file = temp_path.open("wb")
+    pack_file.write(pack_magic)
+    pack_file.write(len(header_bytes).to_bytes(8, "little"))
+    pack_file.write(header_bytes)
+    for path in image_paths:
+        image_file = path.open("rb")
+        pack_file.write(image_file.read())
+        image_file.close()
+    pack_file.close()
+    os.replace(temp_path, out)
+    return out
+
+
+def load_pack(directory: Path) -> dict | None:
+    # the pack in directory, mapped once, and again only when the pack file's modification time changes
+    entry = packs.get(directory)
+    if entry is not None and not current_renderer().check_style_changes:
+        return entry
+    try:
+        mtime = os.stat(directory / pack_name).st_mtime_ns
+    except OSError:
+        if entry is not None:
+            forget_pack(directory)
+        return None
+    if entry is not None and entry["mtime"] == mtime:
+        return entry
+
+    pack_file = (directory / pack_name).open("rb")
+    mapped = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+    pack_file.close()
+    if mapped[:len(pack_magic)] != pack_magic:
+        debug("not an image pack: " + str(directory / pack_name))
+        mapped.close()
+        return None
+    debug("loading image pack " + str(directory / pack_name))
+    start = len(pack_magic) + 8
+    blobs = start + int.from_bytes(mapped[len(pack_magic):start], "little")
+    header = json.loads(mapped[start:blobs])
+
+    if entry is not None:
+        forget_pack(directory)
+    entry = {"mtime": mtime, "files": header["files"], "aliases": header["aliases"]}
+    packs[directory] = entry
+    for name in header["files"]:
+        offset, length, file_mtime = header["files"][name]
+        packed_images[directory / name] = (mapped, blobs + offset, length, file_mtime)
+    return entry
+
+
+def forget_pack(directory: Path):
+    entry = packs.pop(directory)
+    for name in entry["files"]:
+        packed_images.pop(directory / name, None)
+        image_cache.pop(directory / name)
+
+
+def load_packed_image(imagepath: Path) -> Image.Image | None:
+    mapped, offset, length, mtime = packed_images[imagepath]
+    if current_renderer().check_style_changes:
+        # a loose image file that changed since packing wins over the pack
+        try:
+            if os.stat(imagepath).st_mtime_ns != mtime:
+                return None
+        except OSError:
+            pass
+    # only this image's bytes are read from the mapping and decoded
+    image = Image.open(io.BytesIO(mapped[offset:offset + length]))
+    image.load()
+    return image
+
+
+def index_names(names: list[str]) -> dict:
+    # names joined by newlines for substring search, with where each name starts in the joined string,
+    #   and a sorted copy for prefix search
+    starts = []
+    pos = 0
+    for name in names:
+        starts.append(pos)
+        pos += len(name) + 1
+    return {"names": names, "joined": "\n".join(names), "starts": starts, "sorted": sorted(names)}
+
+
+def search_names(index: dict, search: str, prefix: bool = False) -> list[str]:
+    # substring matches are in the original order, prefix matches are sorted
+    if prefix:
+        names = index["sorted"]
+        matches = []
+        for i in range(bisect_left(names, search), len(names)):
+            if not names[i].startswith(search):
+                break
+            matches.append(names[i])
+        return matches
+
+    if search == "":
+        return list(index["names"])
+    names = index["names"]
+    starts = index["starts"]
+    joined = index["joined"]
+    matches = []
+    pos = joined.find(search)
+    while pos != -1:
+        i = bisect_right(starts, pos) - 1
+        name_end = starts[i] + len(names[i])
+        # skip matches that run into the next name
+        if pos + len(search) <= name_end:
+            matches.append(names[i])
+        pos = joined.find(search, name_end + 1)
+    return matches
+
+
+def load_alias_file(path: Path) -> dict | None:
+    # parsed once, and again only when the file's modification time changes
+    entry = alias_files.get(path)
+    if entry is not None and not current_renderer().check_style_changes:
+        return entry
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        alias_files.pop(path, None)
+        return None
+    if entry is None or entry["mtime"] != mtime:
+        debug("loading aliases " + str(path))
+        if path.name == pack_name:
+            pack = load_pack(path.parent)
+            if pack is None:
+                return None
+            aliases = pack["aliases"]
+        else:
+            alias_file = path.open()
+            aliases = json.load(alias_file)
+            alias_file.close()
+        entry = {"mtime": mtime, "aliases": aliases, **index_names(list(aliases))}
+        alias_files[path] = entry
+    return entry
+
+
+def get_alias_index(style: str) -> dict:
+    renderer = current_renderer()
+    key = (renderer.resource_root, style)
+    index = renderer.alias_indexes.get(key)
+    if index is not None and not renderer.check_style_changes:
+        return index
+
+    style_dir = renderer.resource_root / "styles" / style
+    if index is None or stamps_changed(index["stamps"]):
+        # alias files may have been added or removed, so look for them again
+        debug("indexing aliases for " + style)
+        stamps = {}
+        for path in [style_dir] + [path for path in style_dir.rglob("*") if path.is_dir()]:
+            stamps[path] = os.stat(path).st_mtime_ns
+        # packs stand in for the alias.json of directories that don't have one any more
+        paths = list(style_dir.rglob("alias.json"))
+        paths += [path for path in style_dir.rglob(pack_name) if not (path.parent / "alias.json").exists()]
+        index = {"stamps": stamps, "paths": paths, "files": None}
+
+    # only rebuild the lookup tables if an alias file changed since they were built
+    # files lines up with paths, a file removed since the last rglob is None
+    files = [load_alias_file(path) for path in index["paths"]]
+    if index["files"] is None or any(a is not b for a, b in zip(files, index["files"])):
+        index = build_alias_index(index["stamps"], index["paths"], files)
+    renderer.alias_indexes[key] = index
+    return index
+
+
+def build_alias_index(stamps: dict[Path, int], paths: list[Path], files: list[dict]) -> dict:
+    # the first alias file (in rglob order) with a name wins, same as get_image always did
+    lookup = {}
+    for path, alias_file in zip(paths, files):
+        if alias_file is None:
+            continue
+        for alias in alias_file["names"]:
+            if alias not in lookup:
+                lookup[alias] = path.parent / alias_file["aliases"][alias]
+    return {"stamps": stamps, "paths": paths, "files": files, "lookup": lookup, **index_names(sorted(lookup))}
+
+
+def search_aliases(style: str, search: str = "", prefix: bool = False) -> list[str]:
+    # every alias name in the style matching search, sorted and without duplicates, e.g. for autocomplete
+    return search_names(get_alias_index(style), search, prefix)
+
+
 def paste_alpha(base: Image.Image, overlay: Image.Image, offset: tuple = (0, 0)) -> Image.Image:
     padded_overlay = Image.new("RGBA", base.size, (0, 0, 0, 0))
-    padded_overlay.paste(overlay, offset)
+    # paste extends a list offset in place, and offsets come from shared style data
+    padded_overlay.paste(overlay, tuple(offset))
     return Image.alpha_composite(base, padded_overlay)
 
 
+def composite_at(base: Image.Image, overlay: Image.Image, offset: tuple = (0, 0)) -> Image.Image:
+    # same result as paste_alpha, but blends into base in place and only where overlay covers it
+    # transparent overlay pixels leave base untouched, so nothing outside that area changes anyway
+    if overlay.mode != "RGBA":
+        overlay = overlay.convert("RGBA")
+    # alpha_composite can't take negative offsets, so cut off whatever hangs past the top left instead
+    left = max(0, -offset[0])
+    top = max(0, -offset[1])
+    if left >= overlay.width or top >= overlay.height or offset[0] >= base.width or offset[1] >= base.height:
+        return base
+    base.alpha_composite(overlay, (offset[0] + left, offset[1] + top), (left, top))
+    return base
+
+
+def composite_images(images: dict, image_data: dict) -> Image.Image:
+    # layers every resolved image in order onto one canvas, the first image is the canvas if there's no basesize
+    background, imagenames = static_background(images, image_data)
+    if background is not None:
+        return composite_layers(background.copy(), images, image_data, imagenames)
+    return composite_layers(None, images, image_data, imagenames)
+
+
+def composite_layers(composite: Image.Image | None, images: dict, image_data: dict,
+                     imagenames: list[str]) -> Image.Image:
+    if composite is None and "basesize" in images:
+        composite = Image.new("RGBA", images["basesize"], (0, 0, 0, 0))
+    for imagename in imagenames:
+        image = image_data[imagename]
+        if composite is None:
+            composite = image["resolved"].copy()
+            continue
+        composite = composite_at(composite, image["resolved"], images[imagename]["position"])
+    return composite
+
+
+def layer_box(images: dict, image_data: dict, imagename: str) -> tuple:
+    position = images[imagename]["position"]
+    size = image_data[imagename]["resolved"].size
+    return position[0], position[1], position[0] + size[0], position[1] + size[1]
+
+
+def static_background(images: dict, image_data: dict) -> (Image.Image | None, list[str]):
+    # the static layers (static images and static expands) flattened onto the canvas, and the layers left to add
+    # a static layer can be moved ahead of the layers before it as long as it doesn't overlap any of them,
+    #   since compositing separate areas in either order gives the same result
+    # returns None and every layer if that doesn't save anything
+    flattened = []
+    rest = []
+    covered = []
+    for imagename in image_data:
+        image = images[imagename]
+        static = "source" in image_data[imagename] and \
+            (image["type"] == "static" or image["type"] == "expand" and image["mode"] == "static")
+        box = layer_box(images, image_data, imagename)
+        # without a basesize, the first layer is the canvas, so nothing can go before it
+        if static and ("basesize" in images or len(rest) == 0) \
+                and not any(box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]
+                            for other in covered):
+            flattened.append(imagename)
+        else:
+            rest.append(imagename)
+            covered.append(box)
+    if len(flattened) + ("basesize" in images) < 2:
+        return None, list(image_data)
+
+    key = (tuple(images["basesize"]) if "basesize" in images else None,
+           tuple((image_data[imagename]["source"], tuple(images[imagename]["position"]))
+                 for imagename in flattened))
+    background = background_cache.get(key)
+    if background is None:
+        background = composite_layers(None, images, image_data, flattened)
+        background_cache.put(key, background)
+    return background, rest
+
+
 def get_filter(imgfilter: str, default: int = Image.NEAREST):
     match imgfilter.lower():
         case "bilinear":
@@ -79,13 +733,143 @@ def find_nth(haystack, needle, n):
     return start
 
 
+def pixel(value: int) -> int:
+    # 26.6 fixed point to pixels, rounded the same way as Pillow's FreeType code
+    return ((value + 32) & -64) >> 6
+
+
+def get_glyph_table(font: ImageFont.ImageFont | ImageFont.FreeTypeFont) -> dict | None:
+    if font in glyph_tables:
+        return glyph_tables[font]
+    table = None
+    if isinstance(font, ImageFont.FreeTypeFont):
+        # raqm shapes whole runs of text, so its widths can't be built up from single glyphs
+        if font.layout_engine == ImageFont.Layout.BASIC:
+            table = {"glyphs": {}, "pairs": {}}
+    elif isinstance(font, ImageFont.ImageFont):
+        table = {"glyphs": {}, "pairs": None}
+    glyph_tables[font] = table
+    return table
+
+
+def measure_glyph(font: ImageFont.ImageFont | ImageFont.FreeTypeFont, table: dict, char: str) -> tuple:
+    # (advance in 26.6, left edge, lowest possible right edge, highest possible right edge)
+    if char in table["glyphs"]:
+        return table["glyphs"][char]
+    if table["pairs"] is None:
+        # bitmap fonts just add up the advance of each character
+        advance = font.getlength(char)
+        glyph = (advance * 64, 0, advance, advance)
+    else:
+        advance = round(font.getlength(char) * 64)
+        x_min, _, x_max, _ = font.getbbox(char)
+        if x_max > max(0, pixel(advance)):
+            glyph = (advance, x_min, x_max, x_max)
+        else:
+            # the bbox is widened to the advance, so the real right edge is somewhere below it
+            glyph = (advance, x_min, x_min, x_max)
+    table["glyphs"][char] = glyph
+    return glyph
+
+
+def measure_pair(font: ImageFont.ImageFont | ImageFont.FreeTypeFont, table: dict, first: str, second: str) -> int:
+    # kerning, as the change to the advance of the first character
+    if table["pairs"] is None:
+        return 0
+    pair = first + second
+    if pair not in table["pairs"]:
+        table["pairs"][pair] = round(font.getlength(pair) * 64) \
+            - measure_glyph(font, table, first)[0] - measure_glyph(font, table, second)[0]
+    return table["pairs"][pair]
+
+
+def prefix_widths(text: str, font: ImageFont.ImageFont | ImageFont.FreeTypeFont, table: dict,
+                  limit: int) -> list[tuple[int, int]]:
+    # bounds on draw.multiline_textsize(text[:i], font)[0] for each i
+    # this follows the glyph layout in Pillow's font_getsize, stopping once a prefix is wider than limit
+    widths = [(0, 0)]
+
+    if table["pairs"] is None:
+        # bitmap fonts have exact widths, which are just running sums
+        glyphs = table["glyphs"]
+        done = line = 0
+        for char in text:
+            if char == "\n":
+                done = max(done, line)
+                line = 0
+            else:
+                line += glyphs[char][2] if char in glyphs else measure_glyph(font, table, char)[2]
+            width = max(done, line)
+            widths.append((width, width))
+            if width > limit:
+                break
+        return widths
+
+    done_lo = done_hi = 0
+    line_lo = line_hi = 0
+    position = x_min = x_max_lo = x_max_hi = 0
+    last = None
+    last_char = None
+
+    for char in text:
+        if char == "\n":
+            done_lo = max(done_lo, line_lo)
+            done_hi = max(done_hi, line_hi)
+            line_lo = line_hi = 0
+            position = x_min = x_max_lo = x_max_hi = 0
+            last = None
+        else:
+            glyph = measure_glyph(font, table, char)
+            if last is not None:
+                position += last[0] + measure_pair(font, table, last_char, char)
+                x_max_lo = max(x_max_lo, pixel(position))
+                x_max_hi = max(x_max_hi, pixel(position))
+            glyph_pos = pixel(position)
+            x_min = min(x_min, glyph[1] + glyph_pos)
+            x_max_lo = max(x_max_lo, glyph[2] + glyph_pos)
+            x_max_hi = max(x_max_hi, glyph[3] + glyph_pos)
+            end = pixel(position + glyph[0])
+            line_lo = max(x_max_lo, end) - x_min
+            line_hi = max(x_max_hi, end) - x_min
+            last = glyph
+            last_char = char
+
+        widths.append((max(done_lo, line_lo), max(done_hi, line_hi)))
+        if widths[-1][0] > limit:
+            break
+
+    return widths
+
+
+def fit_width(text: str, length: int, maxwidth: int, widths: list[tuple[int, int]] | None,
+              font: ImageFont.ImageFont | ImageFont.FreeTypeFont, draw: ImageDraw.ImageDraw) -> int:
+    # width of text[:length], or a value that compares against maxwidth the same way
+    if widths is None:
+        return draw.multiline_textsize(text[:length], font)[0]
+    if length >= len(widths):
+        # past where prefix_widths stopped, kerning can't pull it back under
+        return maxwidth + 1
+    lo, hi = widths[length]
+    if lo == hi or hi < maxwidth:
+        return hi
+    if lo > maxwidth:
+        return lo
+    return draw.multiline_textsize(text[:length], font)[0]
+
+
 def wrap_text(text: str, maxwidth: int, font: ImageFont.FreeTypeFont,
               draw: ImageDraw.ImageDraw, break_on_any: bool = False) -> str:
     textcut = text[:]
     textout = ""
+    table = get_glyph_table(font)
+    widths = None
+    debugging = current_renderer().debug
 
     while len(textcut) > 0:
-        textwidth = draw.multiline_textsize(textcut, font)[0]
+        if table is not None:
+            # 2px of slack, so that kerning with the next character can't bring a prefix back under maxwidth
+            widths = prefix_widths(textcut, font, table, maxwidth + 2)
+        textwidth = fit_width(textcut, len(textcut), maxwidth, widths, font, draw)
         if textwidth < maxwidth:
             textout += textcut
             break
@@ -96,15 +880,18 @@ def wrap_text(text: str, maxwidth: int, font: ImageFont.FreeTypeFont,
         last_below = 0
         for i in range(0, math.floor(math.log2(len(textcut)) + 1)):
             curpos = (len(textcut[startpos:endpos]) // 2) + startpos
-            textwidth = draw.multiline_textsize(textcut[:curpos], font)[0]
+            textwidth = fit_width(textcut, curpos, maxwidth, widths, font, draw)
 
             # some of this debug info is just wrong and i cant be bothered to fix it, since the search works correctly
-            debug("began binary search iteration " + str(i + 1) + " of " + str(math.floor(math.log2(len(textcut)) + 1))
-                  + " with bounds " + str(startpos) + ":" + str(endpos)
-                  + " and position " + str(curpos) + "/" + str(len(textcut) - 1))
-            debug("search region: " + textcut[startpos - 1:endpos])
-            debug("test region:   " + textcut[:curpos])
-            debug("found width " + str(textwidth) + " (target " + str(maxwidth) + ")")
+            # checked here so the strings aren't even built otherwise
+            if debugging:
+                debug("began binary search iteration " + str(i + 1) + " of "
+                      + str(math.floor(math.log2(len(textcut)) + 1))
+                      + " with bounds " + str(startpos) + ":" + str(endpos)
+                      + " and position " + str(curpos) + "/" + str(len(textcut) - 1))
+                debug("search region: " + textcut[startpos - 1:endpos])
+                debug("test region:   " + textcut[:curpos])
+                debug("found width " + str(textwidth) + " (target " + str(maxwidth) + ")")
 
             if textwidth < maxwidth:
                 startpos = curpos + 1
@@ -116,10 +903,11 @@ def wrap_text(text: str, maxwidth: int, font: ImageFont.FreeTypeFont,
                 last_below = curpos
                 break
 
-        debug("finished binary search with bounds " + str(startpos) + ":" + str(endpos)
-              + " and position " + str(last_below) + "/" + str(len(textcut) - 1))
-        debug("fit region: " + textcut[:last_below])
-        debug("remaining:  " + textcut[last_below:])
+        if debugging:
+            debug("finished binary search with bounds " + str(startpos) + ":" + str(endpos)
+                  + " and position " + str(last_below) + "/" + str(len(textcut) - 1))
+            debug("fit region: " + textcut[:last_below])
+            debug("remaining:  " + textcut[last_below:])
 
         # break at the nearest space instead of the found position, if possible
         breakpos = textcut.rfind(" ", 0, last_below + 1)
@@ -133,24 +921,143 @@ def wrap_text(text: str, maxwidth: int, font: ImageFont.FreeTypeFont,
     return textout
 
 
-def evaluate_predicate(predicate_state: dict[str, list], predicate: str) -> bool:
+def layout_text(text: str, textbox: dict, font: dict, draw: ImageDraw.ImageDraw) -> (str, tuple[int, int]):
+    # wraps and cuts text for a textbox, font is the font data with the resolved font
+    # the font object itself is part of the key, so a reloaded font doesn't reuse old layouts
+    key = (font["resolved"], font["antialias"], font["spacing"],
+           textbox["max_width"], textbox["max_lines"], textbox["line_wrap"], text)
+    layout = layout_cache.get(key)
+    if layout is None:
+        text_wrapped = wrap_text(text, textbox["max_width"], font["resolved"], draw)
+
+        lines = text_wrapped.count("\n") + 1
+        if lines > textbox["max_lines"] and textbox["line_wrap"] == "cut":
+            text_wrapped = text_wrapped[:find_nth(text_wrapped, "\n", textbox["max_lines"])]
+
+        table = get_glyph_table(font["resolved"])
+        if table is not None and table["pairs"] is None:
+            size = bitmap_text_size(text_wrapped, font["resolved"], table, font["spacing"])
+        else:
+            size = draw.multiline_textsize(text_wrapped, spacing=font["spacing"], font=font["resolved"])
+        layout = (text_wrapped, size)
+        layout_cache.put(key, layout)
+    return layout
+
+
+def bitmap_line_width(line: str, font: ImageFont.ImageFont, table: dict) -> int:
+    # exact, bitmap fonts just add up the advance of each character
+    glyphs = table["glyphs"]
+    width = 0
+    for char in line:
+        width += glyphs[char][2] if char in glyphs else measure_glyph(font, table, char)[2]
+    return width
+
+
+def bitmap_line_spacing(font: ImageFont.ImageFont, table: dict, spacing: int) -> int:
+    # Pillow spaces lines by the height of "A", and every glyph of a bitmap font has the same height
+    if "height" not in table:
+        table["height"] = font.getbbox("A")[3]
+    return table["height"] + spacing
+
+
+def bitmap_text_size(text: str, font: ImageFont.ImageFont, table: dict, spacing: int) -> (int, int):
+    # same as draw.multiline_textsize for bitmap fonts, without asking Pillow about every line
+    lines = text.split("\n")
+    width = max(bitmap_line_width(line, font, table) for line in lines)
+    return width, len(lines) * bitmap_line_spacing(font, table, spacing) - spacing
+
+
+def draw_bitmap_text(draw: ImageDraw.ImageDraw, xy: tuple, text: str, font: ImageFont.ImageFont, fill: tuple = None,
+                     anchor: str = None, spacing: int = 4, align: str = "left"):
+    # same as draw.multiline_text for bitmap fonts, but the mask of each line is rendered once and cached
+    # the line placement follows multiline_text, bitmap fonts ignore the anchor after that
+    if anchor is None:
+        anchor = "la"
+    elif len(anchor) != 2 or anchor[1] in "tb":
+        # let Pillow raise the error for it
+        draw.multiline_text(xy, text, fill, font, anchor, spacing, align)
+        return
+    if align not in ("left", "center", "right"):
+        draw.multiline_text(xy, text, fill, font, anchor, spacing, align)
+        return
+
+    table = get_glyph_table(font)
+    lines = text.split("\n")
+    widths = [bitmap_line_width(line, font, table) for line in lines]
+    line_spacing = bitmap_line_spacing(font, table, spacing)
+
+    for line, (left, top) in zip(lines, multiline_positions(xy, widths, anchor, line_spacing, align)):
+        key = (font, draw.fontmode, line)
+        mask = line_mask_cache.get(key)
+        if mask is None:
+            mask = Image.new("L", font.getmask(line, draw.fontmode).size)
+            mask_draw = ImageDraw.Draw(mask)
+            mask_draw.fontmode = draw.fontmode
+            mask_draw.text((0, 0), line, 255, font)
+            line_mask_cache.put(key, mask)
+        draw.bitmap((int(left), int(top)), mask, fill)
+
+
+def multiline_positions(xy: tuple, widths: list, anchor: str, line_spacing: float, align: str) -> list[tuple]:
+    # where multiline_text draws each line (with the anchor), given the width of each line
+    max_width = max(widths)
+    top = xy[1]
+    if anchor[1] == "m":
+        top -= (len(widths) - 1) * line_spacing / 2.0
+    elif anchor[1] == "d":
+        top -= (len(widths) - 1) * line_spacing
+
+    positions = []
+    for width in widths:
+        left = xy[0]
+        width_difference = max_width - width
+        if anchor[0] == "m":
+            left -= width_difference / 2.0
+        elif anchor[0] == "r":
+            left -= width_difference
+        if align == "center":
+            left += width_difference / 2.0
+        elif align == "right":
+            left += width_difference
+        positions.append((left, top))
+        top += line_spacing
+    return positions
+
+
+@lru_cache(maxsize=1024)
+def compile_predicate(predicate: str) -> tuple:
+    # ordered (category, value, invert) parts, category is None for "parse"
+    compiled = []
     for part in predicate.split("&"):
         if part == "always":
             continue
         if part == "parse":
-            debug("Ignoring 'parse' predicate: it should have already been loaded")
-            return False
+            compiled.append((None, None, False))
+            continue
         invert = part.startswith("!")
         if invert:
             part = part[1:]
         mid = part.find(":")
-        if part[:mid] not in predicate_state:
+        compiled.append((part[:mid], part[mid + 1:], invert))
+    return tuple(compiled)
+
+
+def evaluate_compiled(predicate_state: dict, compiled: tuple) -> bool:
+    for category, value, invert in compiled:
+        if category is None:
+            debug("Ignoring 'parse' predicate: it should have already been loaded")
+            return False
+        if category not in predicate_state:
             return True
-        if (part[mid + 1:] not in predicate_state[part[:mid]]) != invert:
+        if (value not in predicate_state[category]) != invert:
             return False
     return True
 
 
+def evaluate_predicate(predicate_state: dict[str, list], predicate: str) -> bool:
+    return evaluate_compiled(predicate_state, compile_predicate(predicate))
+
+
 def load_jsons(data_paths: list[Path]) -> (dict[int, list], dict[str, dict]):
     sorts = {}
     preloads = {}
@@ -173,17 +1080,46 @@ def load_jsons(data_paths: list[Path]) -> (dict[int, list], dict[str, dict]):
     return sorts, preloads
 
 
-def parse_jsons(predicate_state: dict, sorts: dict[int, list]) -> dict[str]:
-    output = {}
-
+def compile_sorts(sorts: dict[int, list]) -> list[tuple]:
+    # (compiled predicate, data) for every data file, in the order they get merged
+    layers = []
     for sort_value in sorted(sorts.keys()):
-        debug("loading sort value " + str(sort_value))
         for data in sorts[sort_value]:
-            if evaluate_predicate(predicate_state, data["predicate"]):
-                output = merge_dicts(output, data)
+            layers.append((compile_predicate(data["predicate"]), data))
+    return layers
+
+
+def parse_jsons(predicate_state: dict, sorts: dict[int, list]) -> dict[str]:
+    # sorts loaded by load_style() keep their compiled predicates and merged results in the style cache
+    # the output shares structure with sorts and other outputs, see merge_dicts
+    entry = None
+    for cached in list(current_renderer().style_cache.values()):
+        if cached["sorts"] is sorts:
+            entry = cached
+            break
+    layers = entry["layers"] if entry is not None else compile_sorts(sorts)
+
+    # the merged data only depends on which data files pass their predicates
+    state = {category: set(predicate_state[category]) for category in predicate_state}
+    mask = 0
+    for i in range(len(layers)):
+        if evaluate_compiled(state, layers[i][0]):
+            mask |= 1 << i
+
+    if entry is not None:
+        output = entry["merged"].get(mask)
+        if output is not None:
+            return output
+
+    output = {}
+    for i in range(len(layers)):
+        if mask & (1 << i):
+            output = merge_dicts(output, layers[i][1])
 
     del output["sort"]
     del output["predicate"]
+    if entry is not None:
+        entry["merged"].put(mask, output)
     return output
 
 
@@ -191,40 +1127,300 @@ def resolve_jsons(predicate_state: dict, data_paths: list[Path]) -> dict[str]:
     return parse_jsons(predicate_state, load_jsons(data_paths)[0])
 
 
+def stamps_changed(stamps: dict[Path, int]) -> bool:
+    for path in stamps:
+        try:
+            if os.stat(path).st_mtime_ns != stamps[path]:
+                return True
+        except OSError:
+            return True
+    return False
+
+
+def load_style(style: str = None) -> (dict[int, list], dict[str, dict]):
+    # style None loads just the default data
+    renderer = current_renderer()
+    key = (renderer.resource_root, style)
+    entry = renderer.style_cache.get(key)
+    if entry is None and style is not None and renderer.use_bundles:
+        # a compiled bundle stands in for the data files, as long as none of them changed since
+        load_bundle(bundle_path(style))
+        entry = renderer.style_cache.get(key)
+    if entry is not None and (not renderer.check_style_changes or not stamps_changed(entry["stamps"])):
+        return entry["sorts"], entry["preload"]
+
+    entry = read_style(style)
+    renderer.style_cache[key] = entry
+    return entry["sorts"], entry["preload"]
+
+
+def read_style(style: str = None) -> dict:
+    # the style cache entry for a style, straight from its data files
+    root = current_renderer().resource_root
+    data_dirs = [root / "default" / "data"]
+    if style is not None:
+        data_dirs.append(root / "styles" / style / "data")
+
+    data_paths = []
+    stamps = {}
+    for data_dir in data_dirs:
+        # directory mtimes catch added and removed files
+        for path in [data_dir] + [path for path in data_dir.rglob("*") if path.is_dir()]:
+            stamps[path] = os.stat(path).st_mtime_ns
+        for path in data_dir.rglob("*.json"):
+            data_paths.append(path)
+            stamps[path] = os.stat(path).st_mtime_ns
+
+    debug("loading style " + str(style))
+    sorts, preload = load_jsons(data_paths)
+    return {"sorts": sorts, "preload": preload, "stamps": stamps,
+            "layers": compile_sorts(sorts), "merged": BoundedCache(256)}
+
+
+def get_default_style() -> str:
+    return load_style()[1]["defaultstyle"]
+
+
+def bundle_path(style: str) -> Path:
+    return current_renderer().resource_root / "styles" / style / "style.bundle"
+
+
+def relative_stamps(stamps: dict[Path, int]) -> dict[str, int]:
+    return {str(path.relative_to(current_renderer().resource_root)): stamps[path] for path in stamps}
+
+
+def absolute_stamps(stamps: dict[str, int]) -> dict[Path, int]:
+    return {current_renderer().resource_root / path: stamps[path] for path in stamps}
+
+
+def compile_style(style: str, out: Path = None) -> Path:
+    # writes the style's data files, compiled predicates, alias files and decoded static images into one file,
+    #   which load_style maps instead of reading the style's files one by one
+    # layout: bundle_magic, header length (8 bytes, little endian), JSON header, raw image data
+    root = current_renderer().resource_root
+    if out is None:
+        out = bundle_path(style)
+    header = {"style": style, "data": {}, "aliases": None, "images": {}}
+    # entry ends up as the style's own data, which includes the default data
+    for name, data_style in (("default", None), ("style", style)):
+        entry = read_style(data_style)
+        header["data"][name] = {
+            "sorts": [[sort_value, entry["sorts"][sort_value]] for sort_value in entry["sorts"]],
+            "preload": entry["preload"],
+            "compiled": [compiled for compiled, _ in entry["layers"]],
+            "stamps": relative_stamps(entry["stamps"])
+        }
+
+    # aliases, along with the directory stamps get_alias_index checks
+    index = get_alias_index(style)
+    header["aliases"] = {
+        "stamps": relative_stamps(index["stamps"]),
+        "files": [[str(path.relative_to(root)), alias_file["mtime"], alias_file["aliases"]]
+                  for path, alias_file in zip(index["paths"], index["files"]) if alias_file is not None]
+    }
+
+    # every image a layer names directly, dynamic images are left to the image files
+    basepath = ""
+    image_names = []
+    for _, data in entry["layers"]:
+        for imagename, image in data.get("images", {}).items():
+            if imagename == "basepath":
+                basepath = image
+            elif isinstance(image, dict) and "path" in image and image["path"] not in image_names:
+                image_names.append(image["path"])
+    image_paths = []
+    for image_name in image_names:
+        imagepath = root / "styles" / style / basepath / image_name
+        if imagepath.exists():
+            image_paths.append(imagepath)
+
+    blobs = []
+    offset = 0
+    for imagepath in image_paths:
+        image = Image.open(imagepath)
+        image.load()
+        if image.mode not in ("1", "L", "LA", "P", "RGB", "RGBA"):
+            continue
+        blob = image.tobytes()
+        meta = {"mode": image.mode, "size": list(image.size), "offset": offset, "length": len(blob),
+                "mtime": os.stat(imagepath).st_mtime_ns}
+        if image.mode == "P":
+            meta["palette"] = [image.palette.mode, image.palette.tobytes().hex()]
+        if "transparency" in image.info:
+            transparency = image.info["transparency"]
+            meta["transparency"] = transparency.hex() if isinstance(transparency, bytes) else transparency
+        header["images"][str(imagepath.relative_to(root))] = meta
+        blobs.append(blob)
+        offset += len(blob)
+
+    header_bytes = json.dumps(header).encode()
+    temp_path = out.with_name(out.name + ".tmp")
+    bundle_file = temp_path.open("wb")
+    bundle_file.write(bundle_magic)
+    bundle_file.write(len(header_bytes).to_bytes(8, "little"))
+    bundle_file.write(header_bytes)
+    for blob in blobs:
+        bundle_file.write(blob)
+    bundle_file.close()
+    os.replace(temp_path, out)
+    return out
+
+
+def load_bundle(path: Path) -> dict | None:
+    # fills the style, alias and image caches from a bundle, returns its header
+    # everything in it is checked against the files' modification times like usual,
+    #   so a stale bundle only means those files get read again
+    try:
+        bundle_file = path.open("rb")
+    except OSError:
+        return None
+    mapped = mmap.mmap(bundle_file.fileno(), 0, access=mmap.ACCESS_READ)
+    bundle_file.close()
+    if mapped[:len(bundle_magic)] != bundle_magic:
+        debug("not a bundle: " + str(path))
+        mapped.close()
+        return None
+    debug("loading bundle " + str(path))
+    start = len(bundle_magic) + 8
+    blobs = start + int.from_bytes(mapped[len(bundle_magic):start], "little")
+    header = json.loads(mapped[start:blobs])
+    # images made from an older mapping of the same file keep it alive until they're gone
+    bundles[path] = mapped
+
+    renderer = current_renderer()
+    root = renderer.resource_root
+    style = header["style"]
+    for name, data_style in (("default", None), ("style", style)):
+        data = header["data"][name]
+        sorts = {}
+        for sort_value, layers in data["sorts"]:
+            sorts[sort_value] = layers
+        layers = []
+        for data_layer, compiled in zip([layer for sort_value in sorted(sorts) for layer in sorts[sort_value]],
+                                        data["compiled"]):
+            layers.append((tuple(tuple(part) for part in compiled), data_layer))
+        # the default data might already be loaded for another style
+        if name == "style" or (root, data_style) not in renderer.style_cache:
+            renderer.style_cache[(root, data_style)] = {
+                "sorts": sorts, "preload": data["preload"], "stamps": absolute_stamps(data["stamps"]),
+                "layers": layers, "merged": BoundedCache(256)
+            }
+
+    paths = []
+    files = []
+    for alias_path, mtime, aliases in header["aliases"]["files"]:
+        paths.append(root / alias_path)
+        files.append({"mtime": mtime, "aliases": aliases, **index_names(list(aliases))})
+        alias_files[paths[-1]] = files[-1]
+    renderer.alias_indexes[(root, style)] = build_alias_index(absolute_stamps(header["aliases"]["stamps"]),
+                                                              paths, files)
+
+    for imagepath in header["images"]:
+        meta = header["images"][imagepath]
+        bundled_images[root / imagepath] = (mapped, blobs + meta["offset"], meta)
+        image_cache.pop(root / imagepath)
+    return header
+
+
+def load_bundled_image(imagepath: Path) -> Image.Image | None:
+    mapped, offset, meta = bundled_images[imagepath]
+    if current_renderer().check_style_changes:
+        try:
+            if os.stat(imagepath).st_mtime_ns != meta["mtime"]:
+                return None
+        except OSError:
+            pass
+    mode = meta["mode"]
+    # for most modes the image uses the mapped data directly, without copying it
+    image = Image.frombuffer(mode, tuple(meta["size"]), memoryview(mapped)[offset:offset + meta["length"]],
+                             "raw", mode, 0, 1)
+    if "palette" in meta:
+        image.putpalette(bytes.fromhex(meta["palette"][1]), meta["palette"][0])
+    if "transparency" in meta:
+        transparency = meta["transparency"]
+        if isinstance(transparency, str):
+            transparency = bytes.fromhex(transparency)
+        elif isinstance(transparency, list):
+            transparency = tuple(transparency)
+        image.info["transparency"] = transparency
+    return image
+
+
 def apply_override(predicate_state: dict, data: dict, override: dict) -> dict:
     debug(data)
     for part in override:
         if evaluate_predicate(predicate_state, override[part]["predicate"]):
             debug("applying override " + part)
-            del override[part]["predicate"]
-            data = merge_dicts(data, override[part])
+            layer = {key: override[part][key] for key in override[part] if key != "predicate"}
+            data = merge_dicts(data, layer)
     return data
 
 
 def merge_dicts(a: dict, b: dict) -> dict:
+    # only dicts that are merged get created, everything else is shared with a and b instead of copied
+    # so treat the output (and anything merged into it) as read-only, and copy a dict before changing it
     output = {}
+    debugging = current_renderer().debug
 
     for key in a:
         if key in b:
             if isinstance(a[key], dict) and isinstance(b[key], dict):
-                debug("merge " + key)
+                if debugging:
+                    debug("merge " + key)
                 output[key] = merge_dicts(a[key], b[key])
             else:
-                debug("overwrite " + key)
-                output[key] = deepcopy(b[key])
+                if debugging:
+                    debug("overwrite " + key)
+                output[key] = b[key]
         else:
-            debug("keep " + key)
-            output[key] = deepcopy(a[key])
+            if debugging:
+                debug("keep " + key)
+            output[key] = a[key]
 
     for key in b:
         if key not in a:
-            debug("append " + key)
-            output[key] = deepcopy(b[key])
+            if debugging:
+                debug("append " + key)
+            output[key] = b[key]
     return output
 
 
+def load_font(fontpath: Path, size: int = None) -> ImageFont.ImageFont | ImageFont.FreeTypeFont:
+    font = font_cache.get((fontpath, size))
+    if font is None:
+        debug("loading font " + str(fontpath))
+        if size is None:
+            font = ImageFont.load(fontpath)
+        else:
+            fontfile = fontpath.open("rb")
+            font = ImageFont.truetype(fontfile, size)
+            fontfile.close()
+        font_cache.put((fontpath, size), font)
+    return font
+
+
+def load_image(imagepath: Path) -> Image.Image:
+    image = image_cache.get(imagepath)
+    if image is None:
+        if imagepath in bundled_images:
+            image = load_bundled_image(imagepath)
+        elif imagepath in packed_images:
+            image = load_packed_image(imagepath)
+        if image is None:
+            debug("loading image " + str(imagepath))
+            image = Image.open(imagepath)
+            image.load()
+        image_cache.put(imagepath, image)
+    return image
+
+
 def create_expand(base_imagepath: Path, image_data: dict) -> Image.Image:
-    base_image = Image.open(base_imagepath)
+    key = (base_imagepath, tuple(image_data["size"]), tuple(image_data["divide"]))
+    output = expand_cache.get(key)
+    if output is not None:
+        return output
+
+    base_image = load_image(base_imagepath)
     # target width and height
     w, h = image_data["size"]
     # division lines on base image
@@ -280,10 +1476,30 @@ def create_expand(base_imagepath: Path, image_data: dict) -> Image.Image:
         output.paste(base_image.resize(section_sizes[section], Image.NEAREST, section_bounds[section]),
                      section_locations[section])
 
+    expand_cache.put(key, output)
     return output
 
 
-def parsestr(textin: str = "", *, out: str = None, presplit: list[str] = None):
+def scale_image(source, image: Image.Image, size: tuple, imgfilter: int) -> (tuple, Image.Image):
+    # image resized, reusing the last resize of the same source (a path or expand key) to the same size
+    # returns the key of the resized image too, so it can be the source of another resize
+    key = (source, tuple(size), imgfilter)
+    scaled = scaled_cache.get(key)
+    if scaled is None:
+        scaled = image.resize(tuple(size), imgfilter)
+        scaled_cache.put(key, scaled)
+    return key, scaled
+
+
+def parsestr(textin: str = "", *, out: str = None, presplit: list[str] = None, output: str = None,
+             image_format: str = None, compress_level: int = None):
+    return generate(**parsestr_args(textin, presplit=presplit), out=out, output=output,
+                    image_format=image_format, compress_level=compress_level)
+
+
+def parsestr_args(textin: str = "", *, presplit: list[str] = None, styles: list[str] = None) -> dict:
+    # parses input the same way as parsestr(), but returns the arguments for generate() instead
+    # if styles is given, only those names are taken as the style, without looking for anything else on disk
     args = textin.split(" ") if presplit is None else presplit
     style = None
     text = {}
@@ -291,24 +1507,20 @@ def parsestr(textin: str = "", *, out: str = None, presplit: list[str] = None):
     flags = []
     mode = "default"
     setpredicates = None
-    default_data = resource_root / "default" / "data"
-    style_root = resource_root / "styles"
+    style_root = current_renderer().resource_root / "styles"
 
     # find the style to use
-    if (style_root / args[0]).exists():
+    if args[0] in styles if styles is not None else (style_root / args[0]).exists():
         style = args[0]
         del args[0]
     if style is None:
-        # need to load just the default parse data to get the default style, could be cached but effort
-        _, preload = load_jsons(list(default_data.rglob("*.json")))
-        style = preload["defaultstyle"]
+        style = get_default_style()
 
     if args[0].startswith("m:"):
         mode = args[0][2:]
         del args[0]
 
-    style_data = style_root / style / "data"
-    sorts, preload = load_jsons(list(default_data.rglob("*.json")) + list(style_data.rglob("*.json")))
+    sorts, preload = load_style(style)
 
     while args[0].startswith("f:"):
         flags.append(args[0][2:])
@@ -346,31 +1558,29 @@ def parsestr(textin: str = "", *, out: str = None, presplit: list[str] = None):
         if len(args) <= 0:
             break
 
-    generate(style, text, images, flags, mode, preload_data=sorts, out=out, add_predicates=setpredicates)
+    return {"style": style, "text": text, "images": images, "flags": flags, "mode": mode,
+            "preload_data": sorts, "add_predicates": setpredicates}
 
 
 def parsestrlist(args: list[str], *, style: str = None, text: dict[str, str] = None,
-                 images: dict[str, str] = None, flags: list[str] = None, out: str = None):
+                 images: dict[str, str] = None, flags: list[str] = None, out: str = None, output: str = None,
+                 image_format: str = None, compress_level: int = None):
     if text is None:
         text = {}
     if images is None:
         images = {}
     if flags is None:
         flags = []
-    default_data = resource_root / "default" / "data"
-    style_root = resource_root / "styles"
+    style_root = current_renderer().resource_root / "styles"
 
     # find the style to use
     if (style_root / args[0]).exists():
         style = args[0]
         del args[0]
     if style is None:
-        # need to load just the default parse data to get the default style, could be cached but effort
-        _, preload = load_jsons(list(default_data.rglob("*.json")))
-        style = preload["defaultstyle"]
+        style = get_default_style()
 
-    style_data = style_root / style / "data"
-    sorts, preload = load_jsons(list(default_data.rglob("*.json")) + list(style_data.rglob("*.json")))
+    sorts, preload = load_style(style)
 
     for argdesc in preload["args"]:
         key, value = argdesc.split(":")
@@ -389,12 +1599,773 @@ def parsestrlist(args: list[str], *, style: str = None, text: dict[str, str] = N
     for remaining in args:
         flags.append(remaining)
 
-    generate(style, text, images, flags, preload_data=sorts, out=out)
+    return generate(style, text, images, flags, preload_data=sorts, out=out, output=output,
+                    image_format=image_format, compress_level=compress_level)
 
 
 def generate(style: str, text: dict[str, str], images: dict[str, str] = None, flags: list[str] = None,
              mode: str = "default", *, out: str = None, preload_data: dict[int, list] = None,
-             add_predicates: dict[str, list] = None):
+             add_predicates: dict[str, list] = None, output: str = None, image_format: str = None,
+             compress_level: int = None):
+    # output can be "image" to return the Image, or "bytes" to return it encoded as image_format
+    # if neither output nor out is given, the image is shown instead
+    key = None
+    cache_format = image_format
+    if current_renderer().use_output_cache and (out is not None or output is not None) \
+            and not resolve_with_paths.get() and (preload_data is None or preload_data is load_style(style)[0]):
+        if cache_format is None and out is not None:
+            # save() would pick the format from the file extension
+            cache_format = Image.registered_extensions().get(os.path.splitext(out)[1].lower())
+        else:
+            cache_format = cache_format or "PNG"
+        if cache_format is not None:
+            key = output_key(style, text, images, flags, mode, add_predicates, cache_format, compress_level)
+
+    if key is not None:
+        encoded = get_cached_output(key)
+        if encoded is None:
+            composite = generate_image(style, text, images, flags, mode,
+                                       preload_data=preload_data, add_predicates=add_predicates)
+            encoded = encode_image(composite, cache_format, compress_level)
+            put_cached_output(key, encoded)
+        else:
+            composite = None
+        if out is not None:
+            out_file = open(out, "wb")
+            out_file.write(encoded)
+            out_file.close()
+        match output:
+            case "image":
+                if composite is None:
+                    composite = Image.open(io.BytesIO(encoded))
+                    composite.load()
+                return composite
+            case "bytes":
+                return encoded
+        return None
+
+    composite = generate_image(style, text, images, flags, mode,
+                               preload_data=preload_data, add_predicates=add_predicates)
+
+    if out is not None:
+        timed = render_stats is not None
+        if timed:
+            start = time.perf_counter()
+        composite.save(out, image_format, **save_options(image_format, compress_level))
+        if timed:
+            record_stage("encode", start)
+    elif output is None:
+        composite.show()
+
+    match output:
+        case "image":
+            return composite
+        case "bytes":
+            return encode_image(composite, image_format, compress_level)
+
+
+def save_options(image_format: str = None, compress_level: int = None) -> dict:
+    # compress_level is the zlib level for PNG, 0 (fastest) to 9 (smallest)
+    if compress_level is not None and (image_format is None or image_format.upper() == "PNG"):
+        return {"compress_level": compress_level}
+    return {}
+
+
+def encode_image(image: Image.Image, image_format: str = None, compress_level: int = None) -> bytes:
+    if image_format is None:
+        image_format = "PNG"
+    timed = render_stats is not None
+    if timed:
+        start = time.perf_counter()
+    output = io.BytesIO()
+    image.save(output, image_format, **save_options(image_format, compress_level))
+    if timed:
+        record_stage("encode", start)
+    return output.getvalue()
+
+
+def style_fingerprint(style: str) -> str:
+    # size and mtime of every file the style can use, hashed
+    # checked again only when a directory or a data file changes, like load_style,
+    #   so call clear_output_cache() after overwriting an image or font in place
+    renderer = current_renderer()
+    key = (renderer.resource_root, style)
+    entry = renderer.style_fingerprints.get(key)
+    if entry is not None and (not renderer.check_style_changes or not stamps_changed(entry["stamps"])):
+        return entry["digest"]
+
+    hasher = hashlib.sha256()
+    stamps = {}
+    for root in (renderer.resource_root / "default", renderer.resource_root / "styles" / style):
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            dirpath = Path(dirpath)
+            stamps[dirpath] = os.stat(dirpath).st_mtime_ns
+            for filename in sorted(filenames):
+                stat = os.stat(dirpath / filename)
+                if dirpath.is_relative_to(root / "data"):
+                    stamps[dirpath / filename] = stat.st_mtime_ns
+                hasher.update((str(dirpath / filename) + "\0" + str(stat.st_size) + "\0"
+                               + str(stat.st_mtime_ns) + "\n").encode())
+    entry = {"digest": hasher.hexdigest(), "stamps": stamps}
+    renderer.style_fingerprints[key] = entry
+    return entry["digest"]
+
+
+def output_key(style: str, text: dict[str, str], images: dict[str, str], flags: list[str], mode: str,
+               add_predicates: dict[str, list], image_format: str, compress_level: int) -> str:
+    request = {"style": style, "text": text, "images": images or {}, "flags": flags or [], "mode": mode,
+               "add_predicates": add_predicates or {}, "format": image_format.upper(),
+               "compress_level": compress_level, "fingerprint": style_fingerprint(style)}
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+
+def get_cached_output(key: str) -> bytes | None:
+    renderer = current_renderer()
+    encoded = renderer.output_cache.get(key)
+    if encoded is not None:
+        with renderer.output_cache_lock:
+            renderer.output_cache_stats["hits"] += 1
+        return encoded
+
+    if renderer.output_cache_dir is not None:
+        path = renderer.output_cache_dir / key
+        try:
+            out_file = path.open("rb")
+            encoded = out_file.read()
+            out_file.close()
+            # the modification time is the last use, for evict_output_dir
+            os.utime(path)
+        except OSError:
+            encoded = None
+        if encoded is not None:
+            with renderer.output_cache_lock:
+                renderer.output_cache_stats["disk_hits"] += 1
+            renderer.output_cache.put(key, encoded)
+            return encoded
+
+    with renderer.output_cache_lock:
+        renderer.output_cache_stats["misses"] += 1
+    return None
+
+
+def put_cached_output(key: str, encoded: bytes):
+    renderer = current_renderer()
+    renderer.output_cache.put(key, encoded)
+    if renderer.output_cache_dir is None:
+        return
+
+    # written under a temporary name first, so other processes never read half a file
+    temp_path = renderer.output_cache_dir / (key + "." + str(os.getpid()) + "." + str(threading.get_ident())
+                                             + ".tmp")
+    try:
+        renderer.output_cache_dir.mkdir(parents=True, exist_ok=True)
+        out_file = temp_path.open("wb")
+        out_file.write(encoded)
+        out_file.close()
+        os.replace(temp_path, renderer.output_cache_dir / key)
+    except OSError as e:
+        # the render itself still worked, so only the disk tier misses out
+        debug("couldn't write cached output " + key + ": " + str(e))
+        return
+
+    with renderer.output_cache_lock:
+        if renderer.output_dir_size is None:
+            renderer.output_dir_size = 0
+            for entry in os.scandir(renderer.output_cache_dir):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    renderer.output_dir_size += entry.stat().st_size
+        else:
+            renderer.output_dir_size += len(encoded)
+        if renderer.output_dir_size > renderer.output_cache_dir_budget:
+            evict_output_dir()
+
+
+def evict_output_dir():
+    # deletes the least recently used outputs until the directory is at 90% of its budget
+    # other processes can share the directory, so the size is measured again first
+    renderer = current_renderer()
+    entries = [entry for entry in os.scandir(renderer.output_cache_dir)
+               if entry.is_file() and not entry.name.endswith(".tmp")]
+    stats = {}
+    for entry in entries:
+        try:
+            stats[entry.path] = entry.stat()
+        except OSError:
+            pass
+    renderer.output_dir_size = sum(stat.st_size for stat in stats.values())
+    for path in sorted(stats, key=lambda path: stats[path].st_mtime_ns):
+        if renderer.output_dir_size <= renderer.output_cache_dir_budget * 0.9:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        renderer.output_dir_size -= stats[path].st_size
+
+
+def clear_output_cache():
+    renderer = current_renderer()
+    renderer.output_cache.clear()
+    renderer.style_fingerprints.clear()
+    with renderer.output_cache_lock:
+        if renderer.output_cache_dir is not None and renderer.output_cache_dir.exists():
+            for entry in os.scandir(renderer.output_cache_dir):
+                if entry.is_file():
+                    os.remove(entry.path)
+            renderer.output_dir_size = 0
+        for stat in renderer.output_cache_stats:
+            renderer.output_cache_stats[stat] = 0
+
+
+def output_cache_info() -> dict:
+    renderer = current_renderer()
+    with renderer.output_cache_lock:
+        info = dict(renderer.output_cache_stats)
+        info["disk_bytes"] = renderer.output_dir_size
+    info["memory_entries"] = len(renderer.output_cache.entries)
+    info["memory_bytes"] = renderer.output_cache.size
+    return info
+
+
+def generate_batch(style: str, items, *, preload_data: dict[int, list] = None, output: str = "image",
+                   image_format: str = None, compress_level: int = None):
+    # items are dicts of generate() arguments: "text", and optionally "images", "flags", "mode" and "add_predicates"
+    # images are rendered lazily as the generator is consumed, output is "image" or "bytes" like for generate()
+    if preload_data is None:
+        preload_data = load_style(style)[0]
+    shared = {"json": {}}
+    for item in items:
+        composite = generate_image(style, item["text"], item.get("images"), item.get("flags"),
+                                   item.get("mode", "default"), preload_data=preload_data,
+                                   add_predicates=item.get("add_predicates"), shared=shared)
+        if output == "bytes":
+            yield encode_image(composite, image_format, compress_level)
+        else:
+            yield composite
+
+
+def list_styles() -> list[str]:
+    stylelist = []
+    for style in (current_renderer().resource_root / "styles").iterdir():
+        if (style / "data").exists():
+            stylelist.append(style.name)
+    return stylelist
+
+
+def warm_style(style: str):
+    # loads the style data, its aliases and every font the style can use, so the first render doesn't have to
+    sorts, _ = load_style(style)
+    get_alias_index(style)
+    data = {}
+    for sort_value in sorted(sorts.keys()):
+        for layer in sorts[sort_value]:
+            data = merge_dicts(data, layer)
+    fontpath = current_renderer().resource_root / "styles" / style / data["fonts"]["basepath"]
+    for fontname in data["fonts"]:
+        font = data["fonts"][fontname]
+        if isinstance(font, dict):
+            if "bitmap" in font:
+                load_font(fontpath / font["bitmap"])
+            elif "path" in font and "size" in font:
+                load_font(fontpath / font["path"], font["size"])
+
+
+def init_render_worker(options: dict, styles: list[str]):
+    # options are Renderer.options() of the renderer in the parent process
+    # set in the worker's main thread, which runs every job afterwards, so it stays active for all of them
+    active_renderer.set(Renderer(**options))
+    for style in styles:
+        try:
+            warm_style(style)
+        except Exception as e:
+            # styles without all their files are normal, jobs using one still get its error when they render
+            print("couldn't load style " + style + ": " + str(e), file=sys.stderr)
+
+
+def render_job(job, compress_level: int = None) -> bytes:
+    # a job is a parsestr() input string, a presplit list for parsestr(), or a dict of generate() arguments
+    if isinstance(job, str):
+        job = parsestr_args(job)
+    elif isinstance(job, list):
+        job = parsestr_args(presplit=job)
+    return encode_image(generate_image(**job), compress_level=compress_level)
+
+
+def render_batch_job(job) -> (bytes | None, str | None):
+    # job is (render_job job, compress_level), failures are returned so they don't stop the rest of a batch
+    try:
+        if isinstance(job[0], Exception):
+            raise job[0]
+        return render_job(*job), None
+    except Exception as e:
+        return None, type(e).__name__ + ": " + str(e)
+
+
+def collect_renders(submitted: deque, ordered: bool, drain: bool):
+    while len(submitted) > 0:
+        if ordered:
+            index, future = submitted.popleft()
+            yield index, future.result()
+        else:
+            done, _ = wait([future for _, future in submitted], return_when=FIRST_COMPLETED)
+            for item in [item for item in submitted if item[1] in done]:
+                submitted.remove(item)
+                yield item[0], item[1].result()
+        if not drain:
+            return
+
+
+def render_parallel(jobs, *, workers: int = None, ordered: bool = True, styles: list[str] = None,
+                    backlog: int = None, render=render_job):
+    # renders jobs (see render_job) on a pool of worker processes, yielding (job index, PNG bytes)
+    # in job order if ordered, or as soon as each one is done otherwise
+    # each worker loads the styles and their fonts once at startup, all of them if styles is None
+    # at most backlog jobs are queued at a time, so jobs can be a lazy iterable
+    # render is what the workers call with each job, and has to be a module level function
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if backlog is None:
+        backlog = workers * 4
+    if styles is None:
+        styles = list_styles()
+
+    executor = ProcessPoolExecutor(workers, initializer=init_render_worker,
+                                   initargs=(current_renderer().options(), styles))
+    try:
+        submitted = deque()
+        for index, job in enumerate(jobs):
+            submitted.append((index, executor.submit(render, job)))
+            if len(submitted) >= backlog:
+                yield from collect_renders(submitted, ordered, False)
+        yield from collect_renders(submitted, ordered, True)
+    finally:
+        # also runs if the caller stops iterating early, dropping any jobs that haven't started
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def read_batch_jobs(lines, names: dict):
+    # each line is a JSON parsestr() string, presplit list, or object of generate() arguments
+    # objects can have "name" for the output file name, or "parse" instead of the generate() arguments
+    # yields (index, job), and stores output names by index in names
+    index = 0
+    for line in lines:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            # rendering it fails, so it's reported like any other failed job
+            job = ValueError("invalid JSON: " + str(e))
+        name = None
+        if isinstance(job, dict):
+            job = dict(job)
+            name = job.pop("name", None)
+            if "parse" in job:
+                job = job["parse"]
+        if name is not None:
+            # only the file name, so jobs can't write anywhere else
+            if isinstance(name, str):
+                name = os.path.basename(name)
+            if not isinstance(name, str) or name in ("", ".", ".."):
+                job = ValueError("invalid name " + json.dumps(name))
+                name = None
+        names[index] = name if name is not None else "{:06d}.png".format(index)
+        yield index, job
+        index += 1
+
+
+def run_batch(lines, *, out_dir: Path = None, tar_out=None, jobs: int = 1, compress_level: int = None,
+              progress=None) -> (int, int):
+    # renders JSON lines jobs (see read_batch_jobs) into out_dir, or into tar_out as an uncompressed tar stream
+    # jobs > 1 renders on that many worker processes, otherwise styles and fonts are kept warm in this one
+    # progress is a text stream to report progress to, returns (rendered, failed)
+    names = {}
+    batch = read_batch_jobs(lines, names)
+    if jobs > 1:
+        results = render_parallel(((job, compress_level) for _, job in batch), workers=jobs, ordered=False,
+                                  render=render_batch_job)
+    else:
+        results = ((index, render_batch_job((job, compress_level))) for index, job in batch)
+
+    tar = tarfile.open(fileobj=tar_out, mode="w|") if tar_out is not None else None
+    if out_dir is not None:
+        out_dir.mkdir(parents=True, exist_ok=True)
+    rendered, failed = 0, 0
+    start = time.perf_counter()
+    last_report = start
+    try:
+        for index, (encoded, error) in results:
+            name = names.pop(index)
+            if error is not None:
+                failed += 1
+                if progress is not None:
+                    progress.write("\njob " + str(index) + " (" + name + ") failed: " + error + "\n")
+                continue
+            if tar is not None:
+                info = tarfile.TarInfo(name)
+                info.size = len(encoded)
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(encoded))
+            else:
+                try:
+                    out_file = (out_dir / name).open("wb")
+                    out_file.write(encoded)
+                    out_file.close()
+                except OSError as e:
+                    failed += 1
+                    if progress is not None:
+                        progress.write("\njob " + str(index) + " (" + name + ") failed: "
+                                       + type(e).__name__ + ": " + str(e) + "\n")
+                    continue
+            rendered += 1
+
+            now = time.perf_counter()
+            if progress is not None and now - last_report >= 0.5:
+                last_report = now
+                progress.write("\rrendered " + str(rendered) + ", " + str(failed) + " failed, "
+                               + str(round(rendered / (now - start), 1)) + "/s")
+                progress.flush()
+    finally:
+        if tar is not None:
+            tar.close()
+    if progress is not None:
+        progress.write("\rrendered " + str(rendered) + ", " + str(failed) + " failed in "
+                       + str(round(time.perf_counter() - start, 2)) + "s\n")
+    return rendered, failed
+
+
+def batch_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog="textboxer.py batch",
+                                     description="Render JSON lines jobs, one parsestr() string, presplit list "
+                                                 "or object of generate() arguments per line")
+    parser.add_argument("input", nargs="?", default="-", help="file to read jobs from, - (the default) for stdin")
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument("--out", help="directory to write the images to")
+    output.add_argument("--tar", help="tar file to write the images to, - for stdout")
+    parser.add_argument("--jobs", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--compress-level", type=int, help="PNG compression level, 0 (fastest) to 9 (smallest)")
+    parser.add_argument("--quiet", action="store_true", help="don't report progress")
+    args = parser.parse_args(argv)
+
+    in_file = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    tar_out = None
+    if args.tar is not None:
+        tar_out = sys.stdout.buffer if args.tar == "-" else open(args.tar, "wb")
+    try:
+        _, failed = run_batch(in_file, out_dir=Path(args.out) if args.out is not None else None, tar_out=tar_out,
+                              jobs=args.jobs, compress_level=args.compress_level,
+                              progress=None if args.quiet else sys.stderr)
+    finally:
+        if in_file is not sys.stdin:
+            in_file.close()
+        if tar_out is not None and tar_out is not sys.stdout.buffer:
+            tar_out.close()
+    return 1 if failed > 0 else 0
+
+
+def render_once(key: str, func):
+    # calls with the same key while one is already running wait for its result, instead of calling func again
+    with server_renders_lock:
+        future = server_renders.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            server_renders[key] = future
+    if owner:
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with server_renders_lock:
+                del server_renders[key]
+    return future.result()
+
+
+def request_args(request: dict) -> dict:
+    # generate() arguments from a render request, see RenderHandler
+    if "parse" in request:
+        # checked against the styles directory first, so a path given as the style is never read
+        args = parsestr_args(str(request["parse"]), styles=list_styles())
+    else:
+        if not isinstance(request.get("text"), dict):
+            raise ValueError("text must be an object of textbox names to text")
+        args = {"style": request.get("style") or get_default_style(), "text": request["text"],
+                "images": request.get("images"), "flags": request.get("flags"),
+                "mode": request.get("mode", "default"), "add_predicates": request.get("add_predicates")}
+    # only styles in the styles directory, so a path can't point the server anywhere else on disk
+    if args["style"] not in list_styles():
+        raise ValueError("unknown style " + str(args["style"]))
+    args["image_format"] = str(request.get("format", "PNG")).upper()
+    compress_level = request.get("compress_level")
+    args["compress_level"] = int(compress_level) if compress_level is not None else None
+    return args
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    # POST /render with a JSON object of generate() arguments ("style", "text", "images", "flags", "mode",
+    #   "add_predicates"), or {"parse": "<parsestr() input>"}
+    # GET /render?parse=<parsestr() input>, for linking to renders
+    # both take "format" and "compress_level" too, and answer with the encoded image
+    # the ETag is the output_key of the request, so it's known before rendering and If-None-Match skips the render
+    protocol_version = "HTTP/1.1"
+    server_version = "textboxer"
+    quiet = False
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path != "/render":
+            self.send_error(404)
+            return
+        self.server.renderer.run(self.render, {key: values[-1] for key, values in parse_qs(url.query).items()})
+
+    def do_POST(self):
+        if urlsplit(self.path).path != "/render":
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            # reading a negative length would wait for the client to close the connection
+            self.send_error(400, "invalid Content-Length")
+            return
+        body = self.rfile.read(length)
+        try:
+            request = json.loads(body)
+        except ValueError as e:
+            self.send_error(400, "invalid JSON: " + str(e))
+            return
+        if not isinstance(request, dict):
+            self.send_error(400, "request must be a JSON object")
+            return
+        self.server.renderer.run(self.render, request)
+
+    def render(self, request: dict):
+        try:
+            args = request_args(request)
+            key = output_key(args["style"], args["text"], args["images"], args["flags"], args["mode"],
+                             args["add_predicates"], args["image_format"], args["compress_level"])
+        except Exception as e:
+            self.send_error(400, type(e).__name__ + ": " + str(e))
+            return
+        etag = '"' + key + '"'
+
+        match = self.headers.get("If-None-Match")
+        if match is not None and (match.strip() == "*" or etag in [tag.strip().removeprefix("W/")
+                                                                     for tag in match.split(",")]):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        try:
+            encoded = render_once(key, partial(generate, **args, output="bytes"))
+        except (ValueError, KeyError) as e:
+            # bad input, like an unknown image or textbox
+            self.send_error(400, type(e).__name__ + ": " + str(e))
+            return
+        except Exception as e:
+            # the server's fault, like a missing font or image file
+            self.send_error(500, type(e).__name__ + ": " + str(e))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", Image.MIME.get(args["image_format"], "application/octet-stream"))
+        self.send_header("Content-Length", str(len(encoded)))
+        self.send_header("ETag", etag)
+        # can be stored, but has to be checked again, which is cheap thanks to the ETag
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+
+def make_server(host: str = "127.0.0.1", port: int = 8000, warm: bool = True) -> ThreadingHTTPServer:
+    # an HTTP server rendering with RenderHandler, call serve_forever() on it to start
+    # port 0 picks a free port, see server_address
+    if warm:
+        for style in list_styles():
+            try:
+                warm_style(style)
+            except Exception as e:
+                # the style still gets its error when something tries to use it
+                print("couldn't load style " + style + ": " + str(e), file=sys.stderr)
+    server = ThreadingHTTPServer((host, port), RenderHandler)
+    # requests are handled on their own threads, which render with the Renderer the server was made with
+    server.renderer = current_renderer()
+    return server
+
+
+def serve_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog="textboxer.py serve", description="Render textboxes over HTTP")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on (default: 8000)")
+    parser.add_argument("--no-warm", action="store_true", help="don't load every style before starting")
+    parser.add_argument("--quiet", action="store_true", help="don't log requests")
+    args = parser.parse_args(argv)
+
+    RenderHandler.quiet = args.quiet
+    server = make_server(args.host, args.port, not args.no_warm)
+    print("serving on http://" + args.host + ":" + str(server.server_address[1]) + "/render", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def get_async_state(loop: asyncio.AbstractEventLoop) -> dict:
+    global async_executor
+    if async_executor is None:
+        async_executor = ThreadPoolExecutor(async_limit, thread_name_prefix="textboxer")
+    # semaphores belong to one event loop, so each loop gets its own
+    state = async_states.get(loop)
+    if state is None:
+        state = {"semaphore": asyncio.Semaphore(async_limit), "inflight": {}}
+        async_states[loop] = state
+    return state
+
+
+async def render_limited(state: dict, func):
+    loop = asyncio.get_running_loop()
+    await state["semaphore"].acquire()
+    try:
+        # in a copy of the caller's context, so the render sees the same current_renderer()
+        future = async_executor.submit(contextvars.copy_context().run, func)
+    except BaseException:
+        state["semaphore"].release()
+        raise
+
+    def release(_):
+        # a render can't be stopped once it started, so its slot is only given back when it's really done
+        # (or cancelled before it started)
+        try:
+            loop.call_soon_threadsafe(state["semaphore"].release)
+        except RuntimeError:
+            # the loop is already closed
+            pass
+
+    future.add_done_callback(release)
+    return await asyncio.wrap_future(future)
+
+
+async def render_coalesced(key, func, timeout: float = None):
+    # callers with the same key while a render is in flight all wait for that one render
+    state = get_async_state(asyncio.get_running_loop())
+    inflight = state["inflight"]
+    entry = inflight.get(key)
+    owner = entry is None
+    if owner:
+        entry = {"task": asyncio.ensure_future(render_limited(state, func)), "waiters": 0}
+        inflight[key] = entry
+
+        def forget(_):
+            if inflight.get(key) is entry:
+                del inflight[key]
+
+        entry["task"].add_done_callback(forget)
+    entry["waiters"] += 1
+
+    try:
+        # shielded, so one caller timing out or being cancelled doesn't cancel the render for the others
+        result = await asyncio.wait_for(asyncio.shield(entry["task"]), timeout)
+    finally:
+        entry["waiters"] -= 1
+        if entry["waiters"] == 0 and not entry["task"].done():
+            debug("no callers left, cancelling render")
+            entry["task"].cancel()
+            if inflight.get(key) is entry:
+                del inflight[key]
+
+    # images are mutable, so callers that joined a render get their own copy
+    if isinstance(result, Image.Image) and not owner:
+        result = result.copy()
+    return result
+
+
+async def agenerate(style: str, text: dict[str, str], images: dict[str, str] = None, flags: list[str] = None,
+                    mode: str = "default", *, out: str = None, preload_data: dict[int, list] = None,
+                    add_predicates: dict[str, list] = None, output: str = "image", image_format: str = None,
+                    compress_level: int = None, timeout: float = None):
+    # generate() on async_executor, without blocking the event loop
+    # output can't be None here, since showing an image from a worker thread makes no sense
+    key = ("generate", id(current_renderer()),
+           json.dumps([style, text, images, flags, mode, add_predicates], sort_keys=True, default=str),
+           id(preload_data) if preload_data is not None else None, out, output, image_format, compress_level)
+    return await render_coalesced(key, partial(generate, style, dict(text), images, flags, mode, out=out,
+                                               preload_data=preload_data, add_predicates=add_predicates,
+                                               output=output, image_format=image_format,
+                                               compress_level=compress_level), timeout)
+
+
+async def aparsestr(textin: str = "", *, out: str = None, presplit: list[str] = None, output: str = "image",
+                    image_format: str = None, compress_level: int = None, timeout: float = None):
+    # parsestr() on async_executor, like agenerate
+    # presplit is copied instead of used up like parsestr does
+    key = ("parsestr", id(current_renderer()), textin, tuple(presplit) if presplit is not None else None,
+           out, output, image_format, compress_level)
+    return await render_coalesced(key, partial(parsestr, textin, out=out,
+                                               presplit=list(presplit) if presplit is not None else None,
+                                               output=output, image_format=image_format,
+                                               compress_level=compress_level), timeout)
+
+
+def load_shared_json(path: Path, shared: dict = None):
+    if shared is not None and path in shared["json"]:
+        return shared["json"][path]
+    json_file = path.open()
+    loaded = json.load(json_file)
+    json_file.close()
+    if shared is not None:
+        shared["json"][path] = loaded
+    return loaded
+
+
+def generate_image(style: str, text: dict[str, str], images: dict[str, str] = None, flags: list[str] = None,
+                   mode: str = "default", *, preload_data: dict[int, list] = None,
+                   add_predicates: dict[str, list] = None, shared: dict = None) -> Image.Image:
+    # shared holds state reused between renders of the same style, see generate_batch
+    # stages are only timed when stats are enabled, checked once so a render can't be half timed
+    timed = render_stats is not None
+    render = resolve_render(style, text, images, flags, mode, preload_data=preload_data,
+                            add_predicates=add_predicates, shared=shared, timed=timed)
+    if timed:
+        start = time.perf_counter()
+
+    composite = composite_images(render["data"]["images"], render["image_data"])
+    if timed:
+        start = record_stage("composite", start)
+
+    draw_textboxes(composite, render)
+    if timed:
+        start = record_stage("text", start)
+
+    if "postscale" in render["data"]:
+        composite = postscale_image(composite, render["data"])
+        if timed:
+            record_stage("postscale", start)
+
+    if timed:
+        with stats_lock:
+            if render_stats is not None:
+                render_stats["renders"] += 1
+    return composite
+
+
+def resolve_render(style: str, text: dict[str, str], images: dict[str, str] = None, flags: list[str] = None,
+                   mode: str = "default", *, preload_data: dict[int, list] = None,
+                   add_predicates: dict[str, list] = None, shared: dict = None, timed: bool = False) -> dict:
+    # everything generate_image needs before compositing: the resolved data, text, fonts and images
+    if timed:
+        start = time.perf_counter()
     predicate_state = {
         "textbox": list(text) if text is not None else [],
         "image": list(images) if images is not None else [],
@@ -406,29 +2377,15 @@ def generate(style: str, text: dict[str, str], images: dict[str, str] = None, fl
             predicate_state[category].extend(add_predicates[category])
 
     debug(predicate_state)
-    default_data = resource_root / "default" / "data"
-    style_dir = resource_root / "styles" / style
-    style_data = style_dir / "data"
+    style_dir = current_renderer().resource_root / "styles" / style
 
-    if preload_data is not None:
-        data = parse_jsons(predicate_state, preload_data)
-    else:
-        data = resolve_jsons(predicate_state, list(default_data.rglob("*.json")) + list(style_data.rglob("*.json")))
+    if preload_data is None:
+        preload_data = load_style(style)[0]
+    data = parse_jsons(predicate_state, preload_data)
     debug(data)
-
-    # resolve font files
-    font_data = {}
-    for fontname in data["fonts"]:
-        if isinstance(data["fonts"][fontname], dict):
-            font_data[fontname] = deepcopy(data["fonts"][fontname])
-            if "bitmap" in font_data[fontname]:
-                font_data[fontname]["resolved"] = ImageFont.load(
-                    style_dir / data["fonts"]["basepath"] / font_data[fontname]["bitmap"]
-                )
-            else:
-                fontfile = (style_dir / data["fonts"]["basepath"] / font_data[fontname]["path"]).open("rb")
-                font_data[fontname]["resolved"] = ImageFont.truetype(fontfile, font_data[fontname]["size"])
-                fontfile.close()
+    # data is shared, so copy anything before changing it
+    data = dict(data)
+    data["images"] = dict(data["images"])
 
     # apply image overrides and resolve dynamic image paths
     imagenames = []
@@ -440,32 +2397,53 @@ def generate(style: str, text: dict[str, str], images: dict[str, str] = None, fl
             if data["images"][imagename]["type"] == "dynamic":
                 debug("resolving " + imagename)
                 imgbasepath = imagepath / data["images"][imagename]["pathprefix"]
+                data["images"][imagename] = dict(data["images"][imagename])
                 data["images"][imagename]["resolvedpath"] = resolve_resource(imgbasepath, images[imagename])
+                if data["images"][imagename]["resolvedpath"] is None:
+                    raise ValueError("unknown " + imagename + " image " + str(images[imagename]))
                 overridepath = imgbasepath / "overrides.json"
                 debug(overridepath)
                 if overridepath.exists() and imgbasepath.is_relative_to(data["images"][imagename]["resolvedpath"]):
                     imgrel = data["images"][imagename]["resolvedpath"].relative_to(imgbasepath)
-                    overridefile = overridepath.open()
-                    overrides = json.load(overridefile)
-                    overridefile.close()
+                    overrides = load_shared_json(overridepath, shared)
                     if str(imgrel) in overrides:
                         overridepath = imgbasepath / overrides[str(imgrel)]
-                        overridefile = overridepath.open()
-                        override = json.load(overridefile)
-                        overridefile.close()
+                        override = load_shared_json(overridepath, shared)
                         debug("loading overrides for " + imgrel.name)
                         data = apply_override(predicate_state, data, override)
 
+    if timed:
+        start = record_stage("resolve", start)
+
+    # resolve font files, but only the ones the textboxes actually use
+    font_data = {}
+    for textboxname in data["textboxes"]:
+        if isinstance(data["textboxes"][textboxname], dict):
+            fontname = data["textboxes"][textboxname]["font"]
+            if fontname in font_data:
+                continue
+            font_data[fontname] = dict(data["fonts"][fontname])
+            fontpath = style_dir / data["fonts"]["basepath"]
+            if "bitmap" in font_data[fontname]:
+                font_data[fontname]["resolved"] = load_font(fontpath / font_data[fontname]["bitmap"])
+            else:
+                font_data[fontname]["resolved"] = load_font(fontpath / font_data[fontname]["path"],
+                                                            font_data[fontname]["size"])
+
+    if timed:
+        start = record_stage("fonts", start)
+
     # preload some textbox data
-    # dummy canvas
-    canvas = ImageDraw.Draw(Image.new("RGBA", (1000, 1000), (0, 0, 0, 0)))
+    # dummy canvas, only used for measuring
+    canvas = ImageDraw.Draw(Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
     default_fontmode = canvas.fontmode
     textbox_data = {}
     for textboxname in data["textboxes"]:
         if isinstance(data["textboxes"][textboxname], dict):
 
             canvas.fontmode = default_fontmode
-            textbox = data["textboxes"][textboxname]
+            # a copy, since the wrapped text and size get stored in it
+            textbox = dict(data["textboxes"][textboxname])
 
             # short-circuit if the data is already there, because it was calculated for
             #   a textbox that either inherits from it or a textbox it inherits from.
@@ -492,22 +2470,17 @@ def generate(style: str, text: dict[str, str], images: dict[str, str] = None, fl
             font = font_data[textbox["font"]]
             if not font["antialias"]:
                 canvas.fontmode = "1"
-            text_wrapped = wrap_text(text[textboxname], textbox["max_width"], font["resolved"], canvas)
-
-            lines = text_wrapped.count("\n") + 1
-            if lines > textbox["max_lines"] and textbox["line_wrap"] == "cut":
-                text_wrapped = text_wrapped[:find_nth(text_wrapped, "\n", textbox["max_lines"])]
-
-            textbox_data[textboxname]["text"] = text_wrapped
-            textbox_data[textboxname]["size"] = canvas.multiline_textsize(text_wrapped,
-                                                                          spacing=font["spacing"],
-                                                                          font=font["resolved"])
+            textbox_data[textboxname]["text"], textbox_data[textboxname]["size"] = \
+                layout_text(text[textboxname], textbox, font, canvas)
 
             if "inherittext" in textbox and textbox["inherittext"] not in textbox_data:
                 textbox_data[textbox["inherittext"]] = textbox
                 textbox_data[textbox["inherittext"]]["text"] = textbox_data[textboxname]["text"]
                 textbox_data[textbox["inherittext"]]["size"] = textbox_data[textboxname]["size"]
 
+    if timed:
+        start = record_stage("layout", start)
+
     # resolve image files
     image_data = {}
     for imagename in data["images"]:
@@ -515,11 +2488,14 @@ def generate(style: str, text: dict[str, str], images: dict[str, str] = None, fl
             imagepath = style_dir / data["images"]["basepath"]
             image_data[imagename] = {}
 
+            # what the image is made from, for scale_image
             match data["images"][imagename]["type"]:
                 case "static":
-                    image_data[imagename]["resolved"] = Image.open(imagepath / data["images"][imagename]["path"])
+                    image_data[imagename]["source"] = imagepath / data["images"][imagename]["path"]
+                    image_data[imagename]["resolved"] = load_image(imagepath / data["images"][imagename]["path"])
                 case "dynamic":
-                    image_data[imagename]["resolved"] = Image.open(data["images"][imagename]["resolvedpath"])
+                    image_data[imagename]["source"] = data["images"][imagename]["resolvedpath"]
+                    image_data[imagename]["resolved"] = load_image(data["images"][imagename]["resolvedpath"])
                 case "expand":
                     # image divided into 9 regions, corners stay static
                     # edges and center are stretched out to fit designated width/height
@@ -530,6 +2506,8 @@ def generate(style: str, text: dict[str, str], images: dict[str, str] = None, fl
                             )
                         case "textbox":
                             tboxname = data["images"][imagename]["textbox"]
+                            data["images"][imagename] = dict(data["images"][imagename])
+                            data["images"][imagename]["size"] = list(data["images"][imagename]["size"])
                             if "x" in data["images"][imagename]["bind_axes"]:
                                 data["images"][imagename]["size"][0] = \
                                     textbox_data[tboxname]["size"][0] + data["images"][imagename]["sizemod"][0]
@@ -539,30 +2517,33 @@ def generate(style: str, text: dict[str, str], images: dict[str, str] = None, fl
                             image_data[imagename]["resolved"] = create_expand(
                                 imagepath / data["images"][imagename]["path"], data["images"][imagename]
                             )
+                    image_data[imagename]["source"] = (imagepath / data["images"][imagename]["path"],
+                                                       tuple(data["images"][imagename]["size"]),
+                                                       tuple(data["images"][imagename]["divide"]))
             if "scaleto" in data["images"][imagename]:
                 imgfilter = Image.BILINEAR
                 if "scalefilter" in data["images"][imagename]:
                     imgfilter = get_filter(data["images"][imagename]["scalefilter"], Image.BILINEAR)
-                image_data[imagename]["resolved"] = image_data[imagename]["resolved"].resize(
+                image_data[imagename]["source"], image_data[imagename]["resolved"] = scale_image(
+                    image_data[imagename]["source"], image_data[imagename]["resolved"],
                     data["images"][imagename]["scaleto"], imgfilter)
     debug(font_data)
     debug(image_data)
     debug(data)
+    if timed:
+        record_stage("images", start)
+    return {"data": data, "text": text, "font_data": font_data, "image_data": image_data}
 
-    composite = None
-    if "basesize" in data["images"]:
-        composite = Image.new("RGBA", data["images"]["basesize"], (0, 0, 0, 0))
-    for imagename in image_data:
-        image = image_data[imagename]
-        if composite is None:
-            composite = image["resolved"].copy()
-            continue
-        composite = paste_alpha(composite, image["resolved"], data["images"][imagename]["position"])
 
+def draw_textboxes(composite: Image.Image, render: dict, textboxes: list[str] = None):
+    # draws the text of a resolved render (see resolve_render), only of the named textboxes if given
+    data, text, font_data = render["data"], render["text"], render["font_data"]
     canvas = ImageDraw.Draw(composite)
     default_fontmode = canvas.fontmode
     for textboxname in data["textboxes"]:
         if isinstance(data["textboxes"][textboxname], dict):
+            if textboxes is not None and textboxname not in textboxes:
+                continue
             canvas.fontmode = default_fontmode
             textbox = data["textboxes"][textboxname]
             font = font_data[textbox["font"]]
@@ -570,18 +2551,8 @@ def generate(style: str, text: dict[str, str], images: dict[str, str] = None, fl
             if not font["antialias"]:
                 canvas.fontmode = "1"
 
-            # use preloaded wrapped text, if applicable
-            if textbox_data[textboxname]["font"] == textbox["font"] \
-                    and textbox_data[textboxname]["max_width"] == textbox["max_width"] \
-                    and textbox_data[textboxname]["max_lines"] == textbox["max_lines"] \
-                    and textbox_data[textboxname]["line_wrap"] == textbox["line_wrap"]:
-                text_wrapped = textbox_data[textboxname]["text"]
-            else:
-                text_wrapped = wrap_text(text[textboxname], textbox["max_width"], font["resolved"], canvas)
-
-                lines = text_wrapped.count("\n") + 1
-                if lines > textbox["max_lines"] and textbox["line_wrap"] == "cut":
-                    text_wrapped = text_wrapped[:find_nth(text_wrapped, "\n", textbox["max_lines"])]
+            # usually already laid out while preloading
+            text_wrapped = layout_text(text[textboxname], textbox, font, canvas)[0]
 
             anchortype = None
             align = "left"
@@ -591,35 +2562,206 @@ def generate(style: str, text: dict[str, str], images: dict[str, str] = None, fl
             if "align" in textbox:
                 align = textbox["align"]
 
-            canvas.multiline_text(textbox["anchor"],
-                                  text_wrapped,
-                                  spacing=font["spacing"],
-                                  font=font["resolved"],
-                                  fill=fill,
-                                  anchor=anchortype,
-                                  align=align)
-
+            table = get_glyph_table(font["resolved"])
+            if table is not None and table["pairs"] is None:
+                draw_bitmap_text(canvas, textbox["anchor"], text_wrapped, font["resolved"], fill=fill,
+                                 anchor=anchortype, spacing=font["spacing"], align=align)
+            else:
+                canvas.multiline_text(textbox["anchor"],
+                                      text_wrapped,
+                                      spacing=font["spacing"],
+                                      font=font["resolved"],
+                                      fill=fill,
+                                      anchor=anchortype,
+                                      align=align)
+
+
+def postscale_image(composite: Image.Image, data: dict) -> Image.Image:
+    cursize = composite.size
+    postscale = data["postscale"]
+    imgfilter = Image.NEAREST
+    if "scalefilter" in data:
+        imgfilter = get_filter(data["scalefilter"])
+    return composite.resize((int(cursize[0] * postscale[0]), int(cursize[1] * postscale[1])), imgfilter)
+
+
+def character_boxes(draw: ImageDraw.ImageDraw, textbox: dict, text_wrapped: str, font: dict) -> list[tuple]:
+    # the area each non-space character of a textbox is drawn in, in order
+    # lines are placed the same way draw_textboxes does, and each character gets the columns up to the next one
+    anchor = textbox.get("anchortype") or "la"
+    align = textbox.get("align", "left")
+    resolved = font["resolved"]
+    lines = text_wrapped.split("\n")
+    table = get_glyph_table(resolved)
+    bitmap = table is not None and table["pairs"] is None
+    if bitmap:
+        widths = [bitmap_line_width(line, resolved, table) for line in lines]
+        line_spacing = bitmap_line_spacing(resolved, table, font["spacing"])
+    else:
+        widths = [draw.textlength(line, resolved) for line in lines]
+        # the same line height multiline_text uses
+        line_spacing = draw.textbbox((0, 0), "A", resolved)[3] + font["spacing"]
+
+    boxes = []
+    for line, width, (left, top) in zip(lines, widths,
+                                         multiline_positions(textbox["anchor"], widths, anchor, line_spacing, align)):
+        if len(line.strip()) == 0:
+            continue
+        if bitmap:
+            # bitmap lines are drawn from their truncated top left corner, ignoring the anchor
+            left, top = int(left), int(top)
+            line_box = (left, top, left + width, top + resolved.getbbox(line)[3])
+            edges = [left + bitmap_line_width(line[:i], resolved, table) for i in range(len(line) + 1)]
+        else:
+            line_box = draw.textbbox((left, top), line, font=resolved, anchor=anchor)
+            origin = left - {"m": 0.5, "r": 1}.get(anchor[0], 0) * width
+            edges = [origin + draw.textlength(line[:i], resolved) for i in range(len(line) + 1)]
+        # the first and last characters of a line also get anything drawn past the edges,
+        #   and each character gets the spaces after it, since ink can spill into them
+        edges[-1] = max(edges[-1], line_box[2])
+        visible = [i for i, char in enumerate(line) if not char.isspace()]
+        starts = [min(edges[0], line_box[0])] + [edges[i] for i in visible[1:]]
+        ends = [edges[i] for i in visible[1:]] + [edges[-1]]
+        for start, end in zip(starts, ends):
+            boxes.append((math.floor(start), math.floor(line_box[1]), math.ceil(end), math.ceil(line_box[3])))
+    return boxes
+
+
+def typewriter_timeline(render: dict, textboxes: list[str], settings: dict) -> (list[int], list[list[tuple]]):
+    # when each character appears in milliseconds, and the boxes it appears in, in every textbox with that text
+    data, text, font_data = render["data"], render["text"], render["font_data"]
+    canvas = ImageDraw.Draw(Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
+    default_fontmode = canvas.fontmode
+    sources = {}
+    for textboxname in textboxes:
+        source = data["textboxes"][textboxname].get("inherittext", textboxname)
+        sources.setdefault(source, []).append(textboxname)
+
+    times = []
+    reveals = []
+    elapsed = 0
+    for source in sources:
+        first = len(times)
+        for textboxname in sources[source]:
+            textbox = data["textboxes"][textboxname]
+            font = font_data[textbox["font"]]
+            canvas.fontmode = default_fontmode if font["antialias"] else "1"
+            text_wrapped = layout_text(text[textboxname], textbox, font, canvas)[0]
+            if textboxname == sources[source][0]:
+                # timed by the first textbox, spaces take time too but don't get frames
+                for char in text_wrapped.replace("\n", ""):
+                    elapsed += settings["char_time"]
+                    if not char.isspace():
+                        times.append(elapsed)
+                        reveals.append([])
+                    if char in settings["pause_chars"]:
+                        elapsed += settings["pause_time"]
+            # other textboxes with the same text can be wrapped differently, but have the same characters
+            for i, box in enumerate(character_boxes(canvas, textbox, text_wrapped, font)):
+                if first + i < len(reveals):
+                    reveals[first + i].append(box)
+    return times, reveals
+
+
+def scale_box(box: tuple, scale: tuple, size: tuple, margin: int) -> tuple:
+    return (max(0, math.floor(box[0] * scale[0]) - margin), max(0, math.floor(box[1] * scale[1]) - margin),
+            min(size[0], math.ceil(box[2] * scale[0]) + margin), min(size[1], math.ceil(box[3] * scale[1]) + margin))
+
+
+def gif_sources(images: list[Image.Image]) -> list[Image.Image]:
+    # converts images to one shared palette made from the last one, with index 255 for transparent pixels
+    # so every frame can be built by pasting between them, without each frame getting its own palette
+    palette = images[-1].convert("RGB").quantize(255)
+    converted = []
+    for image in images:
+        indexed = image.convert("RGB").quantize(palette=palette, dither=Image.Dither.NONE)
+        if "A" in image.getbands():
+            indexed.paste(255, mask=image.getchannel("A").point(lambda a: 255 if a < 128 else 0))
+        converted.append(indexed)
+    return converted
+
+
+def generate_animation(style: str, text: dict[str, str], images: dict[str, str] = None, flags: list[str] = None,
+                       mode: str = "default", *, out: str = None, output: str = None, image_format: str = "GIF",
+                       preload_data: dict[int, list] = None, add_predicates: dict[str, list] = None,
+                       compress_level: int = None):
+    # the text typed out one character at a time, as an animated GIF or APNG (image_format "PNG")
+    # timing comes from the "typewriter" data, the background and untyped textboxes are drawn once,
+    #   and each frame only pastes in the characters that appeared since the last one
+    # saved to out if given, output is "bytes" to return the encoded animation,
+    #   or "frames" to return a list of frames and a list of their durations in milliseconds
+    render = resolve_render(style, text, images, flags, mode, preload_data=preload_data,
+                            add_predicates=add_predicates, timed=render_stats is not None)
+    data = render["data"]
+    settings = data["typewriter"]
+    typed = []
+    for textboxname in data["textboxes"]:
+        textbox = data["textboxes"][textboxname]
+        if isinstance(textbox, dict) and textboxname in render["text"] \
+                and (textboxname in settings["textboxes"] or textbox.get("inherittext") in settings["textboxes"]):
+            typed.append(textboxname)
+
+    background = composite_images(data["images"], render["image_data"])
+    draw_textboxes(background, render, [name for name in data["textboxes"] if name not in typed])
+    full = background.copy()
+    draw_textboxes(full, render, typed)
+    times, reveals = typewriter_timeline(render, typed, settings)
+
+    scale, margin = (1, 1), 0
     if "postscale" in data:
-        cursize = composite.size
-        postscale = data["postscale"]
-        imgfilter = Image.NEAREST
-        if "scalefilter" in data:
-            imgfilter = get_filter(data["scalefilter"])
-        composite = composite.resize((int(cursize[0] * postscale[0]), int(cursize[1] * postscale[1])), imgfilter)
-
-    if out is not None:
-        composite.save(out)
-        return
-    composite.show()
+        background = postscale_image(background, data)
+        full = postscale_image(full, data)
+        scale = data["postscale"]
+        # other filters blend neighbouring pixels, so a bit around each character changes too
+        if get_filter(data.get("scalefilter", "nearest")) != Image.NEAREST \
+                or scale[0] != int(scale[0]) or scale[1] != int(scale[1]):
+            margin = 2
+    if image_format.upper() == "GIF" and output != "frames":
+        background, full = gif_sources([background, full])
+
+    tick = 1000 / settings["fps"]
+    frames, starts = [], []
+    frame = background.copy()
+    shown_at = 0
+    for appears, boxes in zip(times, reveals):
+        appears = round(math.ceil(appears / tick) * tick)
+        if appears > shown_at:
+            frames.append(frame.copy())
+            starts.append(shown_at)
+            shown_at = appears
+        for box in boxes:
+            box = scale_box(box, scale, full.size, margin)
+            frame.paste(full.crop(box), box[:2])
+    frames.append(frame)
+    starts.append(shown_at)
+    durations = [end - start for start, end in zip(starts, starts[1:])] + [settings["end_time"]]
+
+    if output == "frames":
+        return frames, durations
+
+    # both formats only store the changed part of each frame after the first
+    if image_format.upper() == "GIF":
+        options = {"transparency": 255, "disposal": 1, "optimize": False}
+    else:
+        options = {"disposal": 0, "blend": 0, **save_options(image_format, compress_level)}
+    encoded = io.BytesIO() if out is None else out
+    frames[0].save(encoded, image_format, save_all=True, append_images=frames[1:], duration=durations, loop=0,
+                   **options)
+    if out is None:
+        return encoded.getvalue()
+    if output == "bytes":
+        out_file = open(out, "rb")
+        encoded = out_file.read()
+        out_file.close()
+        return encoded
 
 
 def gen_help() -> str:
     output = "Available styles: "
     stylelist = []
     longest_style = 0
-    default_data = resource_root / "default" / "data"
 
-    for style in (resource_root / "styles").iterdir():
+    for style in (current_renderer().resource_root / "styles").iterdir():
         if (style / "data").exists():
             stylelist.append(style.name)
             output += style.name + ", "
@@ -628,14 +2770,12 @@ def gen_help() -> str:
     output = output[:output.rfind(", ")]
 
     output += "\nDefault style: "
-    _, preload = load_jsons(list(default_data.rglob("*.json")))
-    output += preload["defaultstyle"]
+    output += get_default_style()
 
     output += "\nStyle options:"
     flags = {}
     for style in stylelist:
-        style_data = resource_root / "styles" / style / "data"
-        sorts, preload = load_jsons(list(style_data.rglob("*.json")))
+        sorts, preload = load_style(style)
         output += "\n" + style.ljust(longest_style + 3)
         for arg in preload["str"]:
             key, value = arg.split(":")
@@ -672,12 +2812,12 @@ def gen_help() -> str:
     return output
 
 
-def find_aliases(stylein: str = None, search: str = "") -> str:
+def find_aliases(stylein: str = None, search: str = "", prefix: bool = False) -> str:
     stylelist = []
     output = ""
 
     if stylein is None:
-        for style in (resource_root / "styles").iterdir():
+        for style in (current_renderer().resource_root / "styles").iterdir():
             if (style / "data").exists():
                 stylelist.append(style.name)
     else:
@@ -685,17 +2825,16 @@ def find_aliases(stylein: str = None, search: str = "") -> str:
 
     for style in stylelist:
         output += style
-        for aliasfilepath in (resource_root / "styles" / style).rglob("alias.json"):
-            for pathpart in aliasfilepath.relative_to(resource_root / "styles" / style).parts:
+        index = get_alias_index(style)
+        for aliasfilepath, alias_file in zip(index["paths"], index["files"]):
+            if alias_file is None:
+                continue
+            for pathpart in aliasfilepath.relative_to(current_renderer().resource_root / "styles" / style).parts:
                 output += " / " + pathpart
             output += "\n"
-            aliasfile = aliasfilepath.open()
-            aliases = json.load(aliasfile)
-            aliasfile.close()
 
-            for alias in aliases:
-                if search in alias:
-                    output += alias + "\n"
+            for alias in search_names(alias_file, search, prefix):
+                output += alias + "\n"
 
     # trim trailing newline
     output = output[:-1]
@@ -704,14 +2843,31 @@ def find_aliases(stylein: str = None, search: str = "") -> str:
 
 
 def get_image(style: str, image: str) -> Path | None:
-    for aliasfilepath in (resource_root / "styles" / style).rglob("alias.json"):
-        if resolved := resolve_resource(aliasfilepath.parent, image):
-            return resolved
-    return None
+    return get_alias_index(style)["lookup"].get(image)
 
 
 if __name__ == '__main__':
     debug_mode = True
+    if len(sys.argv) > 2 and sys.argv[1] == "compile-style":
+        # textboxer.py compile-style <style> [style...]
+        debug_mode = False
+        for style_name in sys.argv[2:]:
+            print(compile_style(style_name))
+        exit(0)
+    if len(sys.argv) > 2 and sys.argv[1] == "pack-images":
+        # textboxer.py pack-images <directory> [directory...]
+        debug_mode = False
+        for directory_name in sys.argv[2:]:
+            print(pack_images(Path(directory_name)))
+        exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        # textboxer.py serve [--host <address>] [--port <port>], see serve_main
+        debug_mode = False
+        exit(serve_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        # textboxer.py batch [file] (--out <directory> | --tar <file>) [--jobs N], see batch_main
+        debug_mode = False
+        exit(batch_main(sys.argv[2:]))
     if len(sys.argv) > 1:
         parsestr("", presplit=sys.argv[1:])
         exit(0)
@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+
+# Benchmarks for textboxer
+# Run from the repository root, e.g. "python utils/benchmark.py wrap --font path/to/font.ttf"
+# Without --font, Pillow's built-in bitmap font is used, so no game files are needed
+# Image benchmarks use the style data in resources, with random images standing in for missing game files
+# "suite" builds a whole stand-in resource tree (images, faces and fonts) for every style and times each stage
+
+import argparse
+import json
+import math
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+from pathlib import Path
+
+from PIL import BdfFontFile
+from PIL import Image
+from PIL import ImageDraw
+from PIL import ImageFont
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import textboxer
+
+# multiline_textsize is deprecated in newer Pillow versions, and the reference implementations call it a lot
+warnings.simplefilter("ignore", DeprecationWarning)
+
+words = ("the quick brown fox jumps over a lazy dog while OMORI and MARI have a picnic, "
+         "AVAST! WAVY Tokyo... \"quoted\" it's fine, 1333 megaherds; well-known text").split()
+
+
+def make_message(size: int, seed: int = 0) -> str:
+    rnd = random.Random(seed)
+    message = ""
+    while len(message) < size:
+        message += rnd.choice(words) + " "
+    return message[:size]
+
+
+def reference_wrap_text(text: str, maxwidth: int, font, draw: ImageDraw.ImageDraw, break_on_any: bool = False) -> str:
+    # wrap_text as it was before the glyph tables, measuring every probe with multiline_textsize
+    textcut = text[:]
+    textout = ""
+
+    while len(textcut) > 0:
+        textwidth = draw.multiline_textsize(textcut, font)[0]
+        if textwidth < maxwidth:
+            textout += textcut
+            break
+
+        startpos = 0
+        endpos = len(textcut)
+        last_below = 0
+        for i in range(0, math.floor(math.log2(len(textcut)) + 1)):
+            curpos = (len(textcut[startpos:endpos]) // 2) + startpos
+            textwidth = draw.multiline_textsize(textcut[:curpos], font)[0]
+            if textwidth < maxwidth:
+                startpos = curpos + 1
+                last_below = curpos
+            elif textwidth > maxwidth:
+                endpos = curpos - 1
+            else:
+                last_below = curpos
+                break
+
+        breakpos = textcut.rfind(" ", 0, last_below + 1)
+        if breakpos == -1 or break_on_any:
+            textout += textcut[:last_below] + "\n"
+            textcut = textcut[last_below:]
+        else:
+            textout += textcut[:breakpos] + "\n"
+            textcut = textcut[breakpos + 1:]
+
+    return textout
+
+
+def timeit(func, repeat: int) -> float:
+    # best of repeat runs, in seconds
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def load_fonts(fontpaths: list[str], size: int) -> dict:
+    fonts = {}
+    for fontpath in fontpaths:
+        if fontpath.endswith(".pil"):
+            fonts[Path(fontpath).name] = ImageFont.load(fontpath)
+        else:
+            fonts[Path(fontpath).name + " " + str(size)] = ImageFont.truetype(fontpath, size)
+    if len(fonts) == 0:
+        fonts["pillow default (bitmap)"] = ImageFont.load_default()
+    return fonts
+
+
+def bench_wrap(args):
+    draw = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    print("wrap_text, max width " + str(args.width) + ", best of " + str(args.repeat))
+    for fontname, font in load_fonts(args.font, args.size).items():
+        print(fontname)
+        for size in (1024, 2048, 4096):
+            message = make_message(size)
+            expected = reference_wrap_text(message, args.width, font, draw)
+            # fresh tables every run, so the first-use glyph measurements are part of the timing
+            textboxer.glyph_tables.clear()
+            wrapped = textboxer.wrap_text(message, args.width, font, draw)
+            if wrapped != expected:
+                print("  " + str(size) + " bytes: line breaks differ from the reference!")
+                continue
+
+            reference = timeit(lambda: reference_wrap_text(message, args.width, font, draw), args.repeat)
+            cold = timeit(lambda: (textboxer.glyph_tables.clear(),
+                                   textboxer.wrap_text(message, args.width, font, draw)), args.repeat)
+            warm = timeit(lambda: textboxer.wrap_text(message, args.width, font, draw), args.repeat)
+            print(("  {:>5} bytes, {:>3} lines: reference {:8.2f} ms, "
+                   "cold {:7.2f} ms ({:5.1f}x), warm {:7.2f} ms ({:5.1f}x)")
+                  .format(size, wrapped.count("\n") + 1, reference * 1000, cold * 1000, reference / cold,
+                          warm * 1000, reference / warm))
+
+
+def reference_composite_images(images: dict, image_data: dict) -> Image.Image:
+    # compositing as it was before composite_at, with a full canvas blend for every layer
+    composite = None
+    if "basesize" in images:
+        composite = Image.new("RGBA", images["basesize"], (0, 0, 0, 0))
+    for imagename in image_data:
+        image = image_data[imagename]
+        if composite is None:
+            composite = image["resolved"].copy()
+            continue
+        composite = textboxer.paste_alpha(composite, image["resolved"], images[imagename]["position"])
+    return composite
+
+
+def random_image(size, seed: int) -> Image.Image:
+    # noise with varied alpha, so every blend path gets used
+    rnd = random.Random(seed)
+    return Image.frombytes("RGBA", tuple(size), rnd.randbytes(size[0] * size[1] * 4))
+
+
+def load_layout(style: str, frame_size: list[int]) -> (dict, dict):
+    # the images of a style as rendered with a face, using the real image files where they exist
+    sorts, _ = textboxer.load_style(style)
+    predicate_state = {"textbox": ["main", "name"], "image": ["face"], "flag": [], "mode": ["default"]}
+    images = textboxer.parse_jsons(predicate_state, sorts)["images"]
+    image_dir = textboxer.resource_root / "styles" / style / images["basepath"]
+    image_data = {}
+    for seed, imagename in enumerate(images):
+        image = images[imagename]
+        if not isinstance(image, dict):
+            continue
+        if "size" in image:
+            size = image["size"]
+        elif "scaleto" in image:
+            size = image["scaleto"]
+        elif "path" in image and (image_dir / image["path"]).exists():
+            image_data[imagename] = {"resolved": textboxer.load_image(image_dir / image["path"]).convert("RGBA")}
+            continue
+        else:
+            size = images.get("basesize", frame_size)
+        image_data[imagename] = {"resolved": random_image(size, seed)}
+    return images, image_data
+
+
+def bench_composite(args):
+    frame_size = [int(part) for part in args.frame_size.split("x")]
+    print("image compositing, " + str(args.renders) + " renders, best of " + str(args.repeat))
+    for style in args.style or ["omori", "celeste"]:
+        images, image_data = load_layout(style, frame_size)
+        expected = reference_composite_images(images, image_data)
+        composite = textboxer.composite_images(images, image_data)
+        if composite.tobytes() != expected.tobytes():
+            print(style + ": output differs from the reference!")
+            continue
+
+        def run(func):
+            for _ in range(args.renders):
+                func(images, image_data)
+
+        reference = timeit(lambda: run(reference_composite_images), args.repeat)
+        current = timeit(lambda: run(textboxer.composite_images), args.repeat)
+        print("  {:<18} {}x{}, {} layers: reference {:7.3f} ms, composite_images {:7.3f} ms ({:5.1f}x)"
+              .format(style, composite.width, composite.height, len(image_data),
+                      reference * 1000 / args.renders, current * 1000 / args.renders, reference / current))
+
+
+repo_resources = Path(__file__).resolve().parent.parent / "resources"
+font_dirs = [Path("/usr/share/fonts"), Path("/usr/local/share/fonts"), Path.home() / ".fonts",
+             Path("/Library/Fonts"), Path("C:/Windows/Fonts")]
+
+
+def find_truetype(fontpath: str = None) -> Path | None:
+    if fontpath is not None:
+        return Path(fontpath)
+    for font_dir in font_dirs:
+        if font_dir.exists():
+            for path in sorted(font_dir.rglob("*.ttf")):
+                return path
+    return None
+
+
+def write_bitmap_font(path: Path, width: int, height: int, seed: int):
+    # a random printable ASCII font, written as BDF and converted the same way pilfont does
+    rnd = random.Random(seed)
+    lines = ["STARTFONT 2.1", "FONT -standin-" + path.stem + "-medium-r-normal--" + str(height) + "-100-75-75-c-"
+             + str(width * 10) + "-iso8859-1", "SIZE " + str(height) + " 75 75",
+             "FONTBOUNDINGBOX " + str(width) + " " + str(height) + " 0 -2", "STARTPROPERTIES 2",
+             "FONT_ASCENT " + str(height - 2), "FONT_DESCENT 2", "ENDPROPERTIES", "CHARS 95"]
+    for char in range(32, 127):
+        lines += ["STARTCHAR c" + str(char), "ENCODING " + str(char), "SWIDTH 500 0", "DWIDTH " + str(width) + " 0",
+                  "BBX " + str(width) + " " + str(height) + " 0 -2", "BITMAP"]
+        for _ in range(height):
+            lines.append("{:02X}".format(0 if char == 32 else rnd.randrange(256) & (0xff << (8 - width) & 0xff)))
+        lines.append("ENDCHAR")
+    lines.append("ENDFONT")
+    bdf_path = path.with_suffix(".bdf")
+    bdf_path.write_text("\n".join(lines) + "\n")
+    bdf_file = bdf_path.open("rb")
+    BdfFontFile.BdfFontFile(bdf_file).save(str(path))
+    bdf_file.close()
+
+
+def canvas_guess(layers: list) -> list[int]:
+    # rough size of a background image, from where the textboxes are
+    width, height = 64, 32
+    for _, data in layers:
+        for textbox in data.get("textboxes", {}).values():
+            if isinstance(textbox, dict) and "anchor" in textbox:
+                centered = textbox.get("anchortype", "la")[0] == "m"
+                max_width = textbox.get("max_width", 0)
+                width = max(width, textbox["anchor"][0] + (max_width // 2 if centered else max_width) + 16)
+                height = max(height, textbox["anchor"][1] * (2 if centered else 1)
+                             + textbox.get("max_lines", 1) * 32 + 16)
+    return [width, height]
+
+
+def make_assets(root: Path, truetype: Path | None, faces: int) -> list[str]:
+    # copies the style data from the repository, and makes up every file it refers to
+    shutil.copytree(repo_resources / "default", root / "default")
+    styles = []
+    for style_dir in sorted((repo_resources / "styles").iterdir()):
+        if not (style_dir / "data").exists():
+            continue
+        styles.append(style_dir.name)
+        shutil.copytree(style_dir / "data", root / "styles" / style_dir.name / "data")
+        if truetype is None:
+            # without a TrueType font, every font becomes a bitmap font
+            for data_path in (root / "styles" / style_dir.name / "data").rglob("*.json"):
+                data = json.loads(data_path.read_text())
+                for font in data.get("fonts", {}).values():
+                    if isinstance(font, dict) and "path" in font:
+                        font["bitmap"] = "standin.pil"
+                data_path.write_text(json.dumps(data))
+
+    textboxer.resource_root = root
+    rnd = random.Random(0)
+    for style in styles:
+        style_root = root / "styles" / style
+        layers = textboxer.read_style(style)["layers"]
+        basepaths = {"fonts": "", "images": ""}
+        for _, data in layers:
+            for part in basepaths:
+                if "basepath" in data.get(part, {}):
+                    basepaths[part] = data[part]["basepath"]
+        font_dir = style_root / basepaths["fonts"]
+        image_dir = style_root / basepaths["images"]
+        font_dir.mkdir(parents=True, exist_ok=True)
+        image_dir.mkdir(parents=True, exist_ok=True)
+        if truetype is None:
+            write_bitmap_font(font_dir / "standin.pil", 7, 14, 0)
+
+        for _, data in layers:
+            for font in data.get("fonts", {}).values():
+                if not isinstance(font, dict):
+                    continue
+                if "bitmap" in font and not (font_dir / font["bitmap"]).exists():
+                    write_bitmap_font(font_dir / font["bitmap"], 6, 10, rnd.randrange(1 << 16))
+                elif "path" in font and truetype is not None and not (font_dir / font["path"]).exists():
+                    shutil.copy(truetype, font_dir / font["path"])
+
+            for image in data.get("images", {}).values():
+                if not isinstance(image, dict):
+                    continue
+                if "path" in image and not (image_dir / image["path"]).exists():
+                    if image.get("type") == "expand":
+                        dx1, dx2, dy1, dy2 = image["divide"]
+                        size = [dx2 + dx1, dy2 + dy1]
+                    else:
+                        size = canvas_guess(layers)
+                    random_image(size, rnd.randrange(1 << 16)).save(image_dir / image["path"], compress_level=1)
+                elif "pathprefix" in image and not (image_dir / image["pathprefix"] / "alias.json").exists():
+                    face_dir = image_dir / image["pathprefix"]
+                    face_dir.mkdir(parents=True, exist_ok=True)
+                    aliases = {}
+                    for i in range(faces):
+                        random_image(image.get("scaleto", [48, 48]), rnd.randrange(1 << 16)) \
+                            .save(face_dir / ("f" + str(i) + ".png"), compress_level=1)
+                        aliases["face" + str(i)] = "f" + str(i) + ".png"
+                    (face_dir / "alias.json").write_text(json.dumps(aliases))
+    return styles
+
+
+def style_args(style: str, message: str) -> list[str]:
+    # a parsestr() input for a style, filled in from its parse.json
+    _, preload = textboxer.load_style(style)
+    args = [style]
+    for argdesc in preload["str"]:
+        kind, value = argdesc.split(":")
+        match kind:
+            case "text":
+                args.append("Name")
+            case "image":
+                args.append("face1")
+            case "textfill":
+                args += message.split(" ")
+    return args
+
+
+def suite_stages(style: str, messages: list[str]) -> dict:
+    # one function per stage, each call is one operation
+    sorts, _ = textboxer.load_style(style)
+    entry = textboxer.style_cache[(textboxer.resource_root, style)]
+    args = textboxer.parsestr_args(presplit=style_args(style, messages[0]))
+    predicate_state = {"textbox": list(args["text"]), "image": list(args["images"]), "flag": args["flags"],
+                       "mode": [args["mode"]]}
+    data = textboxer.parse_jsons(predicate_state, sorts)
+    data_paths = sorted((textboxer.resource_root / "default" / "data").rglob("*.json")) \
+        + sorted((textboxer.resource_root / "styles" / style / "data").rglob("*.json"))
+    layers = [layer for _, layer in entry["layers"]]
+
+    font = data["fonts"][data["textboxes"]["main"]["font"]]
+    font_dir = textboxer.resource_root / "styles" / style / data["fonts"]["basepath"]
+    if "bitmap" in font:
+        resolved_font = textboxer.load_font(font_dir / font["bitmap"])
+    else:
+        resolved_font = textboxer.load_font(font_dir / font["path"], font["size"])
+    draw = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    wrap_message = make_message(400)
+
+    image_dir = textboxer.resource_root / "styles" / style / data["images"]["basepath"]
+    expands = [image for image in data["images"].values() if isinstance(image, dict)
+               and image.get("type") == "expand" and image.get("mode") == "static"]
+    images, image_data = load_layout(style, canvas_guess(entry["layers"]))
+
+    def parse():
+        entry["merged"].clear()
+        textboxer.parse_jsons(predicate_state, sorts)
+
+    def merge():
+        merged = {}
+        for layer in layers:
+            merged = textboxer.merge_dicts(merged, layer)
+
+    def expand():
+        textboxer.expand_cache.clear()
+        for image in expands:
+            textboxer.create_expand(image_dir / image["path"], image)
+
+    counter = [0]
+
+    def generate():
+        # a different message every time, so it isn't all layout cache hits
+        counter[0] += 1
+        textboxer.parsestr(presplit=style_args(style, messages[counter[0] % len(messages)]), output="image")
+
+    stages = {
+        "load_jsons": lambda: textboxer.load_jsons(data_paths),
+        "parse_jsons": parse,
+        "merge_dicts": merge,
+        "wrap_text": lambda: textboxer.wrap_text(wrap_message, data["textboxes"]["main"]["max_width"],
+                                                 resolved_font, draw),
+        "create_expand": expand if len(expands) > 0 else None,
+        "composite": lambda: textboxer.composite_images(images, image_data),
+        "generate": generate
+    }
+    return {name: stages[name] for name in stages if stages[name] is not None}
+
+
+def measure(func, iterations: int, memory_iterations: int) -> dict:
+    for _ in range(min(5, iterations)):
+        func()
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        func()
+        times.append(time.perf_counter_ns() - start)
+    times.sort()
+
+    # separately, since tracing slows everything down
+    # this only sees memory allocated through Python, not Pillow's image buffers
+    tracemalloc.start()
+    for _ in range(memory_iterations):
+        func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"ops": iterations * 1e9 / sum(times), "p50": times[len(times) // 2] / 1e6,
+            "p99": times[min(len(times) - 1, len(times) * 99 // 100)] / 1e6, "peak": peak / 1024}
+
+
+def bench_suite(args):
+    truetype = find_truetype(args.font)
+    root = Path(tempfile.mkdtemp(prefix="textboxer-bench-"))
+    old_root = textboxer.resource_root
+    try:
+        styles = make_assets(root, truetype, args.faces)
+        if args.style:
+            styles = [style for style in styles if style in args.style]
+        print("stand-in assets in " + str(root) + ", fonts: " + (str(truetype) if truetype else "bitmap only"))
+        messages = [make_message(random.Random(i).randrange(20, 300), i) for i in range(64)]
+        baseline = json.loads(Path(args.compare).read_text()) if args.compare else {}
+
+        results = {}
+        regressions = []
+        print("{:<18} {:<14} {:>10} {:>9} {:>9} {:>11}  {}".format(
+            "style", "stage", "ops/s", "p50 ms", "p99 ms", "peak KiB", "vs baseline p50" if baseline else ""))
+        for style in styles:
+            for stage, func in suite_stages(style, messages).items():
+                key = style + "/" + stage
+                iterations = args.iterations if stage != "generate" else max(1, args.iterations // 4)
+                result = measure(func, iterations, min(iterations, 10))
+                results[key] = result
+                compared = ""
+                if key in baseline:
+                    ratio = result["p50"] / baseline[key]["p50"]
+                    compared = "{:5.2f}x".format(ratio)
+                    if ratio > 1 + args.threshold:
+                        compared += " REGRESSION"
+                        regressions.append(key)
+                print("{:<18} {:<14} {:>10.1f} {:>9.3f} {:>9.3f} {:>11.1f}  {}".format(
+                    style, stage, result["ops"], result["p50"], result["p99"], result["peak"], compared))
+
+        if args.save:
+            Path(args.save).write_text(json.dumps(results, indent=1))
+            print("saved to " + args.save)
+        if regressions:
+            print(str(len(regressions)) + " stage(s) slower than the baseline by more than "
+                  + str(round(args.threshold * 100)) + "%: " + ", ".join(regressions))
+            sys.exit(1)
+    finally:
+        textboxer.resource_root = old_root
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for textboxer")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    wrap_parser = subparsers.add_parser("wrap", help="text wrapping against the old binary search")
+    wrap_parser.add_argument("--font", action="append", default=[],
+                             help="TTF/OTF or Pillow bitmap font to measure with, can be given more than once")
+    wrap_parser.add_argument("--size", type=int, default=28, help="font size for TTF/OTF fonts")
+    wrap_parser.add_argument("--width", type=int, default=564, help="max width to wrap to")
+    wrap_parser.add_argument("--repeat", type=int, default=3)
+    wrap_parser.set_defaults(func=bench_wrap)
+
+    composite_parser = subparsers.add_parser("composite", help="image compositing against full canvas blends")
+    composite_parser.add_argument("--style", action="append",
+                                  help="style to take the layout from, can be given more than once "
+                                       "(default omori and celeste)")
+    composite_parser.add_argument("--frame-size", default="1800x400",
+                                  help="size for missing background images that set the canvas size")
+    composite_parser.add_argument("--renders", type=int, default=50)
+    composite_parser.add_argument("--repeat", type=int, default=3)
+    composite_parser.set_defaults(func=bench_composite)
+
+    suite_parser = subparsers.add_parser("suite", help="every stage of the render pipeline for every style, "
+                                                       "with stand-in assets")
+    suite_parser.add_argument("--style", action="append", help="only benchmark this style, can be given more than once")
+    suite_parser.add_argument("--font", help="TrueType font to stand in for the styles' fonts "
+                                             "(default: the first one found on the system, or bitmap fonts)")
+    suite_parser.add_argument("--faces", type=int, default=50, help="stand-in images per dynamic image directory")
+    suite_parser.add_argument("--iterations", type=int, default=200, help="per stage, a quarter of this for generate")
+    suite_parser.add_argument("--save", help="save the results as a baseline JSON file")
+    suite_parser.add_argument("--compare", help="compare against a baseline saved with --save")
+    suite_parser.add_argument("--threshold", type=float, default=0.2,
+                              help="how much slower p50 can be than the baseline before it counts as a regression")
+    suite_parser.set_defaults(func=bench_suite)
+
+    parsed = parser.parse_args()
+    parsed.func(parsed)